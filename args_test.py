@@ -0,0 +1,24 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Test that the argument parsers of all scripts can be built and parse the common options."""
+
+from libs.utils.args import get_args, get_generator_args
+from libs.utils.nao_utils import get_nao_search_args
+
+__author__ = 'fyabc'
+
+
+def main():
+    for name, get_fn in (
+            ('train', get_args),
+            ('generate', get_generator_args),
+            ('nao', get_nao_search_args),
+    ):
+        assert get_fn(['-T', 'de_en_iwslt']).cpu is False, name
+        assert get_fn(['-T', 'de_en_iwslt', '--cpu']).cpu is True, name
+        print('{}: OK'.format(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Randomized comparison of ``_make_batches_fast`` against the reference ``_make_batches``."""
+
+import contextlib
+import io
+import random
+from types import SimpleNamespace
+
+import numpy as np
+
+from libs.utils.data_processing import _make_batches, _make_batches_fast
+
+__author__ = 'fyabc'
+
+
+def _random_case(rng):
+    num_samples = rng.randint(0, 500)
+    max_len = rng.choice([5, 20, 100, 300])
+    src = SimpleNamespace(sizes=np.array([rng.randint(1, max_len) for _ in range(num_samples)], dtype=np.int64))
+    trg = SimpleNamespace(sizes=np.array([rng.randint(1, max_len) for _ in range(num_samples)], dtype=np.int64))
+    if rng.random() < 0.2:
+        trg = None
+    indices = np.arange(num_samples)
+    if rng.random() < 0.5:
+        indices = indices[np.argsort(src.sizes, kind='mergesort')]
+    else:
+        rng.shuffle(indices)
+    kwargs = {
+        'max_tokens': rng.choice([50, 300, 1000, 4000]),
+        'max_sentences': rng.choice([float('Inf'), 1, 7, 64]),
+        'max_positions': (rng.randint(max_len // 2, max_len), rng.randint(max_len // 2, max_len)),
+        'ignore_invalid_inputs': rng.random() < 0.8,
+        'allow_different_src_lens': rng.random() < 0.5,
+        'required_batch_size_multiple': rng.choice([1, 8]),
+    }
+    return src, trg, indices, kwargs
+
+
+def _run(make_batches, src, trg, indices, kwargs):
+    # Do not print warnings of ignored samples.
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            return [list(b) for b in make_batches(src, trg, indices, **kwargs)]
+        except Exception as e:
+            # Invalid sizes without ``ignore_invalid_inputs``.
+            return str(e)
+
+
+def main(num_cases=3000, seed=1):
+    rng = random.Random(seed)
+    for case in range(num_cases):
+        src, trg, indices, kwargs = _random_case(rng)
+        expected = _run(_make_batches, src, trg, indices, kwargs)
+        result = _run(_make_batches_fast, src, trg, indices, kwargs)
+        assert result == expected, 'Case {}: {}'.format(case, kwargs)
+    print('{} random cases: OK'.format(num_cases))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,12 @@ __author__ = 'fyabc'
 
 def main(args=None):
     hparams = get_args(args)
-    if UseFairseqParallel:
+    if hparams.cpu:
+        if hparams.cpu_workers > 1:
+            multiprocessing_main(hparams)
+        else:
+            single_process_main(hparams)
+    elif UseFairseqParallel:
         if hparams.distributed_port > 0 or hparams.distributed_init_method is not None:
             raise NotImplementedError('Distributed training is not implemented')
         elif hparams.distributed_world_size > 1:
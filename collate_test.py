@@ -0,0 +1,83 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Randomized comparison of ``LanguagePairDataset.collate_indices`` against the reference ``collate``."""
+
+import random
+
+import numpy as np
+import torch as th
+
+from libs.utils.data_processing import LanguagePairDataset, CollateBuffers
+
+__author__ = 'fyabc'
+
+PadId, EosId = 1, 2
+
+
+class _TokenDataset:
+    """Sentences in a flat token buffer, same layout as ``IndexedTextDataset``."""
+    def __init__(self, sentences):
+        self.sizes = np.array([len(s) for s in sentences], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.buffer = np.concatenate(sentences).astype(np.int16)
+        self.dictionary = None
+
+    def __getitem__(self, index):
+        return th.from_numpy(self.buffer[self.offsets[index]:self.offsets[index + 1]])
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def _random_sentences(rng, num, max_len):
+    return [np.array([rng.randint(3, 50) for _ in range(rng.randint(0, max_len))] + [EosId]) for _ in range(num)]
+
+
+def _check(dataset, indices, buffers):
+    expected = dataset.collate([dataset[i] for i in indices], PadId, EosId, has_target=True)
+    result = dataset.collate_indices(indices, buffers=buffers)
+
+    # [NOTE]: Samples with same source lengths may be in different orders, compare them by ids.
+    ids = result['id'].tolist()
+    expected_ids = expected['id'].tolist()
+    assert sorted(ids) == sorted(expected_ids)
+    order = [expected_ids.index(i) for i in ids]
+
+    assert th.equal(expected['target'][order], result['target'])
+    for key in ('src_tokens', 'src_lengths', 'trg_tokens'):
+        assert th.equal(expected['net_input'][key][order], result['net_input'][key]), key
+    assert expected['ntokens'] == result['ntokens']
+
+    # ``collate`` does not sort ``trg_lengths`` (they are in the order of samples), ``collate_indices`` sorts
+    # them with the other fields.
+    trg_lengths = result['net_input']['trg_lengths']
+    assert th.equal(trg_lengths, th.LongTensor([dataset.trg.sizes[i] for i in ids]))
+    assert th.equal(trg_lengths, (result['target'] != PadId).long().sum(dim=1))
+    sample_order = [indices.index(i) for i in ids]
+    assert th.equal(expected['net_input']['trg_lengths'][sample_order], trg_lengths)
+
+
+def main(num_cases=400, seed=1):
+    rng = random.Random(seed)
+    num_samples = 300
+    dataset = LanguagePairDataset(
+        _TokenDataset(_random_sentences(rng, num_samples, 20)),
+        _TokenDataset(_random_sentences(rng, num_samples, 20)),
+        PadId, EosId)
+    buffers = CollateBuffers(num_slots=2)
+
+    left_pads = LanguagePairDataset.LEFT_PAD_SOURCE, LanguagePairDataset.LEFT_PAD_TARGET
+    try:
+        for case in range(num_cases):
+            LanguagePairDataset.LEFT_PAD_SOURCE = rng.random() < 0.5
+            LanguagePairDataset.LEFT_PAD_TARGET = rng.random() < 0.5
+            indices = rng.sample(range(num_samples), rng.randint(1, 40))
+            _check(dataset, indices, buffers if case % 2 else None)
+    finally:
+        LanguagePairDataset.LEFT_PAD_SOURCE, LanguagePairDataset.LEFT_PAD_TARGET = left_pads
+    print('{} random cases: OK'.format(num_cases))
+
+
+if __name__ == '__main__':
+    main()
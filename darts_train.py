@@ -4,7 +4,6 @@
 # TODO: Support multi-card parallel training.
 
 import collections
-import itertools
 import logging
 import math
 import os
@@ -39,6 +38,9 @@ def _concat(xs):
 
 
 class DartsTrainer(ChildTrainer):
+    # [NOTE]: Flags.
+    ShardOptimState = False     # The unrolled model reads the optimizer state of each parameter.
+
     def __init__(self, hparams, model, criterion):
         super().__init__(hparams, model, criterion)
 
@@ -260,6 +262,7 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
         num_shards=hparams.distributed_world_size,
         start=0,
         end=train_search_split,
+        batch_offset=batch_offset,
     )
 
     # Initialize search dataloader from training data.
@@ -278,7 +281,6 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
         end=None,
     )
 
-    next(itertools.islice(itr, batch_offset, batch_offset), None)
     progress = build_progress_bar(hparams, itr, epoch, no_progress_bar='simple')
 
     # Reset training meters
@@ -0,0 +1,233 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Test distributed utilities with gloo on CPU processes.
+
+1. Bucketed all-reduce (--bucket-all-reduce): compare the gradients and backward + all-reduce time with the
+    monolithic all-reduce, and report the overlap.
+2. Logging outputs: check that the tensor all-reduce of logging outputs gives the same stats and aggregated
+    logging outputs as the pickled ``all_gather_list``, for known keys, and for unknown keys (fallback).
+3. Backward OOM with bucketed all-reduce: one process runs out of memory in the middle of backward, check that
+    parameters of all processes are still same after the update.
+"""
+
+import argparse
+from itertools import chain
+import random
+import time
+
+import torch as th
+import torch.nn as nn
+import torch.distributed as dist
+
+from libs.child_trainer import ChildTrainer
+from libs.criterions.cross_entropy import CrossEntropyCriterion
+from libs.criterions.label_smoothed_cross_entropy import LabelSmoothedCrossEntropyCriterion
+from libs.utils import distributed_utils
+from libs.utils.args import get_args
+
+__author__ = 'fyabc'
+
+
+def _build_model(hparams):
+    th.manual_seed(1)
+    layers = []
+    for _ in range(hparams.layers):
+        layers.extend([nn.Linear(hparams.hidden, hparams.hidden), nn.ReLU()])
+    return nn.Sequential(*layers)
+
+
+def _flatten_grads(model):
+    params = list(model.parameters())
+    flat_grads = params[0].data.new_zeros(sum(p.numel() for p in params))
+    offset = 0
+    for p in params:
+        p.grad = flat_grads[offset:offset + p.numel()].view_as(p)
+        offset += p.numel()
+    return flat_grads
+
+
+def _backward(model, rank, step, hparams):
+    th.manual_seed(1000 * step + rank)
+    x = th.randn(hparams.batch_size, hparams.hidden)
+    model(x).pow(2).mean().backward()
+
+
+def _test_bucketed_all_reduce(rank, hparams):
+    results = {}
+    for mode in ('monolithic', 'bucketed', 'bucketed_flat'):
+        model = _build_model(hparams)
+        flat_grads = _flatten_grads(model) if mode == 'bucketed_flat' else None
+        reducer = None
+        if mode != 'monolithic':
+            reducer = distributed_utils.BucketedAllReducer(
+                model.parameters(), bucket_size=int(hparams.bucket_mb * 1024 * 1024), flat_grads=flat_grads)
+
+        total_time, overlap, wait_time = 0.0, 0.0, 0.0
+        for step in range(hparams.steps):
+            for p in model.parameters():
+                if p.grad is not None:
+                    p.grad.data.zero_()
+            dist.barrier()
+            start_time = time.time()
+            if reducer is not None:
+                reducer.prepare(True)
+                _backward(model, rank, step, hparams)
+                reducer.wait()
+                overlap += reducer.overlap()
+                wait_time += reducer.wait_time
+            else:
+                _backward(model, rank, step, hparams)
+                grads = th.cat([p.grad.data.view(-1) for p in model.parameters()])
+                dist.all_reduce(grads)
+                offset = 0
+                for p in model.parameters():
+                    p.grad.data.view(-1).copy_(grads[offset:offset + p.numel()])
+                    offset += p.numel()
+            total_time += time.time() - start_time
+        if reducer is not None:
+            reducer.remove()
+        grads = th.cat([p.grad.data.view(-1) for p in model.parameters()])
+        results[mode] = grads, total_time / hparams.steps, overlap / hparams.steps, wait_time / hparams.steps
+
+    if rank == 0:
+        ref = results['monolithic'][0]
+        for mode, (grads, step_time, overlap, wait_time) in results.items():
+            print('{:>14}: max diff = {:.3g}, backward + all-reduce = {:.2f} ms, overlap = {:.1%}, '
+                  'wait = {:.2f} ms'.format(mode, (grads - ref).abs().max().item(), step_time * 1000,
+                                            overlap, wait_time * 1000))
+            assert th.allclose(grads, ref, rtol=1e-5, atol=1e-6), mode
+
+
+def _random_logging_outputs(rank, num, keys=distributed_utils.LoggingOutputKeys):
+    random.seed(rank)
+    logs = [{
+        'ntokens': random.randint(1000, 4000),
+        'nsentences': random.randint(50, 200),
+        'loss': random.random() * 10000,
+        'nll_loss': random.random() * 10000,
+        'sample_size': random.randint(1000, 4000),
+    } for _ in range(num)]
+    return [{k: v for k, v in log.items() if k in keys} for log in logs]
+
+
+def _assert_same_aggregation(reduced_logs, gathered_logs, name):
+    for key in ('ntokens', 'nsentences'):
+        assert sum(log.get(key, 0) for log in reduced_logs) == sum(log.get(key, 0) for log in gathered_logs), \
+            (name, key)
+    for criterion in (CrossEntropyCriterion, LabelSmoothedCrossEntropyCriterion):
+        expected = criterion.aggregate_logging_outputs(gathered_logs)
+        result = criterion.aggregate_logging_outputs(reduced_logs)
+        assert result.keys() == expected.keys(), (name, criterion.__name__)
+        for key, value in expected.items():
+            assert abs(result[key] - value) <= 1e-9 * abs(value), (name, criterion.__name__, key)
+
+
+def _test_logging_outputs(rank, hparams):
+    # (name, logging outputs of this process, stats of this process).
+    cases = [
+        # Buffered stats of an update with --update-freq 4, like ``ChildTrainer.train_step``.
+        ('train', _random_logging_outputs(rank, 4), [rank + 1, 0, rank]),
+        # One logging output of a validation batch, like ``ChildTrainer.valid_step``.
+        ('valid', _random_logging_outputs(rank, 1), [rank + 1]),
+        # Keys that are missing in all processes are missing in the summed logging output.
+        ('missing_key', _random_logging_outputs(rank, 2, keys=('loss', 'ntokens', 'sample_size')), [1]),
+        # No logging outputs in this process (e.g. all batches are empty).
+        ('empty', _random_logging_outputs(rank, 0 if rank == 0 else 2), [0]),
+        # Unknown keys and non-number values fall back to the gathered logging outputs.
+        ('unknown_key', [dict(log, extra=rank) if rank == 0 else log for log in _random_logging_outputs(rank, 2)],
+         [rank]),
+        ('non_number', [dict(log, loss='nan') if rank == 1 else log for log in _random_logging_outputs(rank, 2)],
+         [rank]),
+    ]
+
+    for name, logging_outputs, stats in cases:
+        gathered = distributed_utils.all_gather_list((logging_outputs, stats))
+        gathered_logs = list(chain.from_iterable(logs for logs, _ in gathered))
+        gathered_stats = [sum(s) for s in zip(*(stats for _, stats in gathered))]
+
+        reduced_logs, reduced_stats = distributed_utils.all_reduce_logging_outputs(logging_outputs, stats)
+        assert reduced_stats == gathered_stats, name
+        if name in ('unknown_key', 'non_number'):
+            assert reduced_logs == gathered_logs, name
+        else:
+            assert len(reduced_logs) == 1, name
+            for key in distributed_utils.LoggingOutputKeys:
+                assert (key in reduced_logs[0]) == any(key in log for log in gathered_logs), (name, key)
+            _assert_same_aggregation(reduced_logs, gathered_logs, name)
+        if rank == 0:
+            print('Logging outputs ({}): same as all_gather_list'.format(name))
+
+
+def _build_trainer(rank, hparams, flat_params):
+    trainer_hparams = get_args(
+        ['--cpu', '--optimizer', 'sgd', '--lr', '0.1', '--lr-scheduler', 'fixed', '--momentum', '0.9',
+         '--weight-decay', '0', '--clip-norm', '0', '--bucket-all-reduce',
+         '--all-reduce-bucket-mb', str(hparams.bucket_mb)] + (['--flat-params'] if flat_params else []))
+    trainer_hparams.distributed_world_size = hparams.world_size
+    trainer_hparams.distributed_rank = rank
+    trainer_hparams.lr = [0.1]
+    return ChildTrainer(trainer_hparams, _build_model(hparams), nn.Module())
+
+
+def _raise_oom(grad):
+    raise RuntimeError('CUDA out of memory (simulated)')
+
+
+def _test_backward_oom(rank, hparams):
+    oom_rank, oom_step = hparams.world_size - 1, 1
+    for flat_params in (False, True):
+        trainer = _build_trainer(rank, hparams, flat_params)
+        model = trainer.model
+        for step in range(3):
+            th.manual_seed(1000 * step + rank)
+            x = th.randn(hparams.batch_size, hparams.hidden)
+            trainer._grad_reducer.prepare(True)
+            hidden = model[0](x)
+            if rank == oom_rank and step == oom_step:
+                # Gradients of the last layers are ready and their buckets are launched before the OOM.
+                hidden.register_hook(_raise_oom)
+            loss = model[1:](hidden).pow(2).mean()
+            oom = trainer._backward(loss)
+            if rank == oom_rank and step == oom_step:
+                assert oom == 1 and trainer._grad_reducer.overlapped_bytes > 0
+            trainer._all_reduce_and_scale(hparams.world_size)
+            trainer._opt()
+        trainer._grad_reducer.remove()
+
+        params = th.cat([p.data.view(-1) for p in model.parameters()])
+        gathered = [th.empty_like(params) for _ in range(hparams.world_size)]
+        dist.all_gather(gathered, params)
+        for i, other in enumerate(gathered):
+            assert th.equal(other, params), 'flat_params={}: parameters of rank {} and {} differ by {:.3g}'.format(
+                flat_params, rank, i, (other - params).abs().max().item())
+        if rank == 0:
+            print('Backward OOM (flat_params={}): parameters of all processes are same'.format(flat_params))
+
+
+def _run(rank, hparams):
+    th.set_num_threads(1)
+    dist.init_process_group(backend='gloo', init_method=hparams.init_method,
+                            world_size=hparams.world_size, rank=rank)
+    _test_bucketed_all_reduce(rank, hparams)
+    _test_logging_outputs(rank, hparams)
+    _test_backward_oom(rank, hparams)
+    dist.destroy_process_group()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser('Test distributed utilities with gloo on CPU.')
+    parser.add_argument('--world-size', default=2, type=int)
+    parser.add_argument('--layers', default=8, type=int)
+    parser.add_argument('--hidden', default=512, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--bucket-mb', default=1.0, type=float)
+    parser.add_argument('--steps', default=10, type=int)
+    hparams = parser.parse_args(args)
+    hparams.init_method = 'tcp://localhost:{}'.format(random.randint(10000, 20000))
+
+    th.multiprocessing.spawn(_run, args=(hparams,), nprocs=hparams.world_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import logging
 import math
 import os
 
+import numpy as np
 import torch as th
 try:
     from tqdm import tqdm
@@ -13,8 +14,9 @@ except ImportError:
 
 from .utils.main_utils import main_entry
 from .utils.paths import get_model_path, get_translate_output_path
-from .utils.data_processing import ShardedIterator
+from .utils.data_processing import ShardedIterator, RawInputIterator
 from .utils.meters import StopwatchMeter
+from .utils.generator_utils import OrderedOutputWriter
 from .utils import common
 from .tasks import get_task
 from .models.child_net_base import ChildIncrementalDecoderBase
@@ -30,7 +32,7 @@ class ChildGenerator:
             self, hparams, datasets, models, maxlen=None,
             subset=_sentinel, quiet=_sentinel, output_file=_sentinel, use_task_maxlen=_sentinel,
             maxlen_a=_sentinel, maxlen_b=_sentinel, max_tokens=_sentinel, max_sentences=_sentinel,
-            lenpen=_sentinel, beam=_sentinel,
+            lenpen=_sentinel, beam=_sentinel, input_file=_sentinel,
     ):
         """
 
@@ -54,6 +56,8 @@ class ChildGenerator:
         self.maxlen_b = hparams.maxlen_b if maxlen_b is _sentinel else maxlen_b
         self.max_tokens = hparams.max_tokens if max_tokens is _sentinel else max_tokens
         self.max_sentences = hparams.max_sentences if max_sentences is _sentinel else max_sentences
+        # Translate a raw text file ('-' means stdin) instead of the subset, see ``RawInputIterator``.
+        self.input_file = getattr(hparams, 'input_file', None) if input_file is _sentinel else input_file
 
         max_decoder_len = min(m.max_decoder_positions() for m in self.models)
         max_decoder_len -= 1  # we define maxlen not including the EOS marker
@@ -67,14 +71,24 @@ class ChildGenerator:
         # Options support in future
         self.retain_dropout = False
 
-    def get_input_iter(self, repeat=1, sort_by_length=True):
+    def get_input_iter(self, repeat=1, sort_by_length=True, start_id=0):
+        if self.input_file is not None:
+            return RawInputIterator(
+                self.input_file, self.datasets.source_dict,
+                max_tokens=self.max_tokens, max_sentences=self.max_sentences,
+                max_positions=min(model.max_encoder_positions() for model in self.models),
+                buffer_size=getattr(self.hparams, 'input_buffer_size', 10000),
+                num_workers=getattr(self.hparams, 'input_workers', 1),
+                start_line=start_id,
+            )
+
         itr = self.datasets.eval_dataloader(
             self.subset,
             max_tokens=self.max_tokens,
             max_sentences=self.max_sentences,
             max_positions=min(model.max_encoder_positions() for model in self.models),
             skip_invalid_size_inputs_valid_test=self.hparams.skip_invalid_size_inputs_valid_test,
-            repeat=repeat, sort_by_length=sort_by_length,
+            repeat=repeat, sort_by_length=sort_by_length, start_id=start_id,
         )
 
         if self.hparams.num_shards > 1:
@@ -106,51 +120,104 @@ class ChildGenerator:
             return self._beam_search_slow(sample, beam, gen_timer)
 
     def decoding(self, beam=None):
-        itr = self.get_input_iter()
+        """Translate the input.
+
+        If ``output_file`` is set, translations are written into it in the input order as soon as they are
+        complete (see ``OrderedOutputWriter``), and None is returned. With ``--resume-output``, translations already
+        in the output file are kept and their inputs are skipped.
+
+        Returns:
+            list: Translated strings in the input order, or None if written into the output file.
+        """
+        writer = None
+        if self.output_file is not None:
+            output_path = get_translate_output_path(self.hparams)
+            os.makedirs(output_path, exist_ok=True)
+            writer = OrderedOutputWriter(
+                os.path.join(output_path, self.output_file),
+                resume=getattr(self.hparams, 'resume_output', False),
+                fsync_interval=getattr(self.hparams, 'output_fsync_interval', 30.0))
+            translated_strings = None
+        elif self.input_file is not None:
+            # Number of lines is unknown until the input is exhausted.
+            translated_strings = []
+        else:
+            gen_subset_len = len(self.datasets.get_dataset(self.subset))
+            translated_strings = [None for _ in range(gen_subset_len)]
+
+        try:
+            itr = self.get_input_iter(start_id=writer.num_written if writer is not None else 0)
+            if writer is not None and self.input_file is None:
+                writer.skip(self._missing_ids(itr, writer.num_written))
+            self._decoding(itr, beam, writer, translated_strings)
+        finally:
+            if writer is not None:
+                writer.close()
+                logging.info('Decode output write to {}.'.format(writer.path))
+
+        return translated_strings
 
+    def _missing_ids(self, itr, start_id):
+        """Get ids from ``start_id`` that are not in the batches of ``itr``.
+
+        [NOTE]: These are inputs skipped by ``--skip-invalid-size-inputs-valid-test`` and inputs of other shards.
+        """
+        num_shards, shard_id = 1, 0
+        if isinstance(itr, ShardedIterator):
+            num_shards, shard_id = itr.num_shards, itr.shard_id
+            itr = itr.itr
+        dataset = self.datasets.get_dataset(self.subset)
+        planned = np.zeros(len(dataset), dtype=bool)
+        for i, batch in enumerate(itr.dataset.batches):
+            if i % num_shards == shard_id:
+                planned[batch] = True
+        missing_ids = np.flatnonzero(~planned[start_id:]) + start_id
+        if len(missing_ids) > 0:
+            logging.info('Write empty lines for {} inputs that are skipped or of other shards'.format(
+                len(missing_ids)))
+        return missing_ids.tolist()
+
+    def _decoding(self, itr, beam, writer, translated_strings):
         gen_timer = StopwatchMeter()
 
         src_dict, trg_dict = self.datasets.source_dict, self.datasets.target_dict
 
-        gen_subset_len = len(self.datasets.get_dataset(self.subset))
-
-        translated_strings = [None for _ in range(gen_subset_len)]
         if self.quiet and tqdm is not None:
             itr = tqdm(itr)
         for i, sample in enumerate(itr):
             batch_translated_tokens = self.decoding_one_batch(sample, beam, gen_timer)
             if not self.quiet:
                 print('Batch {}:'.format(i))
-            for id_, src_tokens, trg_tokens, translated_tokens in zip(
-                    sample['id'], sample['net_input']['src_tokens'], sample['target'], batch_translated_tokens):
-                trans_str = trg_dict.string(translated_tokens, bpe_symbol=self.task.BPESymbol, escape_unk=True)
+            batch_trans_str = trg_dict.decode_batch(
+                batch_translated_tokens, bpe_symbol=self.task.BPESymbol, escape_unk=True)
+            for id_, trans_str in zip(sample['id'].tolist(), batch_trans_str):
+                if writer is not None:
+                    writer.write(id_, trans_str)
+                    continue
+                if id_ >= len(translated_strings):
+                    translated_strings.extend(None for _ in range(id_ + 1 - len(translated_strings)))
                 translated_strings[id_] = trans_str
-                if not self.quiet:
-                    print('SOURCE:', src_dict.string(src_tokens, bpe_symbol=self.task.BPESymbol))
-                    print('REF   :', trg_dict.string(trg_tokens, bpe_symbol=self.task.BPESymbol, escape_unk=True))
+            if not self.quiet:
+                batch_src_str = src_dict.decode_batch(sample['net_input']['src_tokens'], bpe_symbol=self.task.BPESymbol)
+                if sample['target'] is not None:
+                    batch_ref_str = trg_dict.decode_batch(
+                        sample['target'], bpe_symbol=self.task.BPESymbol, escape_unk=True)
+                else:
+                    batch_ref_str = ['' for _ in batch_src_str]
+                for src_str, ref_str, trans_str in zip(batch_src_str, batch_ref_str, batch_trans_str):
+                    print('SOURCE:', src_str)
+                    print('REF   :', ref_str)
                     print('DECODE:', trans_str)
             if not self.quiet:
                 print()
 
-        logging.info('Translated {} sentences in {:.1f}s ({:.2f} sentences/s)'.format(
-            gen_timer.n, gen_timer.sum, 1. / gen_timer.avg))
-
-        # Dump decoding outputs.
-        if self.output_file is not None:
-            output_path = get_translate_output_path(self.hparams)
-            os.makedirs(output_path, exist_ok=True)
-            full_path = os.path.join(output_path, self.output_file)
-            with open(full_path, 'w', encoding='utf-8') as f:
-                for line in translated_strings:
-                    assert line is not None, 'There is a sentence not being translated'
-                    print(line, file=f)
-            logging.info('Decode output write to {}.'.format(full_path))
-
-        return translated_strings
+        if gen_timer.n > 0:
+            logging.info('Translated {} sentences in {:.1f}s ({:.2f} sentences/s)'.format(
+                gen_timer.n, gen_timer.sum, 1. / gen_timer.avg))
 
     def _get_maxlen(self, srclen):
         if self.use_task_maxlen:
-            a, b = self.task.get_maxlen_a_b()
+            a, b = self.datasets.get_maxlen_a_b()
         else:
             a, b = self.maxlen_a, self.maxlen_b
         maxlen = max(1, int(a * srclen + b))
@@ -3,14 +3,18 @@
 
 """Multiprocessing training functions."""
 
+from collections import OrderedDict
+import logging
 import os
 import random
 import signal
 
+import numpy as np
 import torch
 
 from .child_train_sp import single_process_main
 from .utils import distributed_utils
+from .utils.data_processing import LanguageDatasets
 
 __author__ = 'fyabc'
 
@@ -45,12 +49,37 @@ class ErrorHandler:
         raise Exception(msg)
 
 
+def _split_cores(num_workers):
+    """Split the available CPU cores into contiguous groups, one for each worker."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if num_workers > len(cores):
+        logging.warning('{} CPU workers on {} cores, workers will share cores'.format(num_workers, len(cores)))
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    return [group.tolist() for group in np.array_split(cores, num_workers)]
+
+
 def multiprocessing_main(hparams):
     # Set distributed training parameters for a single node.
-    hparams.distributed_world_size = torch.cuda.device_count()
+    if hparams.cpu:
+        # [NOTE]: On CPU, each worker process is pinned to its own group of cores.
+        hparams.distributed_world_size = hparams.cpu_workers
+        hparams.distributed_backend = 'gloo'
+        core_groups = _split_cores(hparams.cpu_workers)
+        logging.info('CPU workers: {}, cores: {}'.format(hparams.cpu_workers, core_groups))
+    else:
+        hparams.distributed_world_size = torch.cuda.device_count()
+        core_groups = None
     hparams.distributed_init_method = 'tcp://localhost:{port}'.format(
         port=random.randint(10000, 20000))
 
+    # Load datasets once in the parent, and share them with all training processes.
+    datasets = LanguageDatasets(hparams)
+    datasets.load_splits(list(OrderedDict.fromkeys([hparams.train_subset] + hparams.valid_subset.split(','))))
+    datasets.share_memory()
+
     mp = torch.multiprocessing.get_context('spawn')
 
     # Create a thread to listen for errors in the child processes.
@@ -62,17 +91,24 @@ def multiprocessing_main(hparams):
     for i in range(hparams.distributed_world_size):
         hparams.distributed_rank = i
         hparams.device_id = i
-        procs.append(mp.Process(target=run, args=(hparams, error_queue,), daemon=True))
+        hparams.cpu_cores = core_groups[i] if core_groups is not None else None
+        procs.append(mp.Process(target=run, args=(hparams, error_queue, datasets), daemon=True))
         procs[i].start()
         error_handler.add_child(procs[i].pid)
     for p in procs:
         p.join()
 
 
-def run(hparams, error_queue):
+def run(hparams, error_queue, datasets=None):
     try:
+        cores = getattr(hparams, 'cpu_cores', None)
+        if cores is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cores)
+            if hparams.num_threads is None:
+                hparams.num_threads = len(cores)
         hparams.distributed_rank = distributed_utils.distributed_init(hparams)
-        single_process_main(hparams)
+        single_process_main(hparams, datasets=datasets)
     except KeyboardInterrupt:
         pass  # killed by parent, do nothing
     except Exception:
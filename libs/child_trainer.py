@@ -12,7 +12,7 @@ import torch.nn as nn
 
 from .optimizers import build_optimizer
 from .optimizers.lr_schedulers import build_lr_scheduler
-from .utils import common, distributed_utils, UseFairseqParallel
+from .utils import common, distributed_utils
 from .utils.meters import AverageMeter, TimeMeter
 
 __author__ = 'fyabc'
@@ -25,6 +25,11 @@ class ChildTrainer:
     process. Gradients are accumulated with torch.distributed.all_reduce and all
     model replicas are updated synchronously after each batch.
     """
+
+    # [NOTE]: Flags.
+    FlatParams = True           # Support flat parameter and gradient buffers (--flat-params).
+    ShardOptimState = True      # Support sharded optimizer state over processes (--shard-optim-state).
+
     def __init__(self, hparams, model, criterion):
         """
 
@@ -33,22 +38,57 @@ class ChildTrainer:
             model:
             criterion:
         """
-        if not th.cuda.is_available():
-            raise NotImplementedError('Training on CPU is not supported')
+        self.cuda = not getattr(hparams, 'cpu', False)
+        if self.cuda and not th.cuda.is_available():
+            raise RuntimeError('CUDA is not available, use --cpu to train on CPU')
 
         self.hparams = hparams
         self.num_gpus = hparams.distributed_world_size
 
         # Copy model and criterion to current device
         if model is not None:
-            self.model = model.cuda()
+            self.model = model.cuda() if self.cuda else model
         else:
             self.model = None
-        self.criterion = criterion.cuda()
+        self.criterion = criterion.cuda() if self.cuda else criterion
+
+        shard_optim_state = model is not None and getattr(hparams, 'shard_optim_state', False) and \
+            distributed_utils.is_multiprocess()
+        if shard_optim_state and not self.ShardOptimState:
+            logging.warning('{} does not support --shard-optim-state, ignored'.format(self.__class__.__name__))
+            shard_optim_state = False
+
+        # Flat buffers that parameters and gradients are views of, see ``_flatten_params``.
+        self._flat_params_buffer = None
+        self._flat_grads_buffer = None
+        if model is not None and getattr(hparams, 'flat_params', False):
+            if self.FlatParams:
+                self._flatten_params(pad_to=th.distributed.get_world_size() if shard_optim_state else 1)
+            else:
+                logging.warning('{} does not support --flat-params, ignored'.format(self.__class__.__name__))
+
+        # Shards of the flat parameter buffer, this process only owns the optimizer state of its shard.
+        self._param_shards = None
+        self._optim_shard = None
+        # (num_updates, state) of the consolidated optimizer state, reused by all checkpoints of the same update.
+        self._consolidated_optim_state = None
+        if shard_optim_state:
+            if self._flat_params_buffer is not None:
+                self._shard_params()
+            else:
+                logging.warning('--shard-optim-state requires flat parameters (--flat-params), ignored')
+
+        # All-reduce gradients in buckets during backward, see ``distributed_utils.BucketedAllReducer``.
+        self._grad_reducer = None
+        if model is not None and getattr(hparams, 'bucket_all_reduce', False) and distributed_utils.is_multiprocess():
+            self._grad_reducer = distributed_utils.BucketedAllReducer(
+                self.model.parameters(), bucket_size=int(hparams.all_reduce_bucket_mb * 1024 * 1024),
+                flat_grads=self._flat_grads_buffer)
+            logging.info('Bucketed all-reduce: {} buckets'.format(len(self._grad_reducer.buckets)))
 
         # Initialize optimizer and LR scheduler
         if model is not None:
-            self.optimizer = build_optimizer(self.hparams, self.model.parameters())
+            self.optimizer = build_optimizer(self.hparams, self._get_optim_params())
             self.lr_scheduler = build_lr_scheduler(self.hparams, self.optimizer)
             logging.info('Optimizer: {}'.format(self.optimizer.__class__.__name__))
             logging.info('LR Scheduler: {}'.format(self.lr_scheduler.__class__.__name__))
@@ -88,12 +128,19 @@ class ChildTrainer:
 
     def save_checkpoint(self, filename, extra_state):
         """Save all training state in a checkpoint file."""
+        # [NOTE]: Must be called in all processes to consolidate sharded optimizer state.
+        optimizer_state = None
+        if self._optim_shard is not None:
+            # [NOTE]: All processes must take part in the gather, even if only the master saves checkpoints.
+            if self._consolidated_optim_state is None or self._consolidated_optim_state[0] != self._num_updates:
+                self._consolidated_optim_state = self._num_updates, self._consolidate_optim_state()
+            optimizer_state = self._consolidated_optim_state[1]
         if distributed_utils.is_master(self.hparams):
             extra_state['train_meters'] = self.meters
             model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
             common.save_state(filename, self.hparams, model, self.criterion, self.optimizer,
                               self.lr_scheduler, self._num_updates, self._optim_history, extra_state,
-                              model.net_code)
+                              model.net_code, optimizer_state=optimizer_state)
 
     def load_checkpoint(self, filename):
         """Load all training state from a checkpoint file."""
@@ -101,11 +148,11 @@ class ChildTrainer:
         model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
 
         extra_state, self._optim_history, last_optim_state = common.load_model_state(
-            filename, model, cuda_device=th.cuda.current_device())
+            filename, model, cuda_device=th.cuda.current_device() if self.cuda else None, cpu=not self.cuda)
 
         if last_optim_state is not None:
             # rebuild optimizer after loading model, since params may have changed
-            self.optimizer = build_optimizer(self.hparams, model.parameters())
+            self.optimizer = build_optimizer(self.hparams, self._get_optim_params())
             self.lr_scheduler = build_lr_scheduler(self.hparams, self.optimizer)
 
             # only reload optimizer and lr_scheduler if they match
@@ -113,6 +160,9 @@ class ChildTrainer:
             if last_optim['criterion_name'] == self.criterion.__class__.__name__:
                 self.lr_scheduler.load_state_dict(last_optim['lr_scheduler_state'])
                 if last_optim['optimizer_name'] == self.optimizer.__class__.__name__:
+                    if self._optim_shard is not None:
+                        last_optim_state = self._shard_optim_state(last_optim_state)
+                        self._consolidated_optim_state = None
                     self.optimizer.load_state_dict(last_optim_state)
 
             self._num_updates = last_optim['num_updates']
@@ -130,12 +180,16 @@ class ChildTrainer:
         # reproducible results when resuming from checkpoints
         seed = self.hparams.seed + self.get_num_updates()
         th.manual_seed(seed)
-        th.cuda.manual_seed(seed)
+        if self.cuda:
+            th.cuda.manual_seed(seed)
 
         sample = self._prepare_sample(sample, volatile=False)
 
         # forward pass
         loss, sample_size, logging_output, oom_fwd = self._forward(sample)
+        if self._grad_reducer is not None:
+            # Only all-reduce in the last backward pass before the update.
+            self._grad_reducer.prepare(update_params)
         oom_bwd = self._backward(loss)
 
         # buffer stats and logging outputs
@@ -150,15 +204,13 @@ class ChildTrainer:
             logging_outputs = self._buffered_stats['logging_outputs']
             ooms_fwd = self._buffered_stats['ooms_fwd']
             ooms_bwd = self._buffered_stats['ooms_bwd']
-            if UseFairseqParallel and self.hparams.distributed_world_size > 1:
-                sample_sizes, logging_outputs, ooms_fwd, ooms_bwd = map(
-                    lambda l: list(chain.from_iterable(l)),
-                    zip(*distributed_utils.all_gather_list(
-                        (sample_sizes, logging_outputs, ooms_fwd, ooms_bwd)
-                    ))
-                )
-            ooms_fwd = sum(ooms_fwd)
-            ooms_bwd = sum(ooms_bwd)
+            if distributed_utils.is_multiprocess():
+                logging_outputs, (sample_size, ooms_fwd, ooms_bwd) = distributed_utils.all_reduce_logging_outputs(
+                    logging_outputs, [sum(sample_sizes), sum(ooms_fwd), sum(ooms_bwd)])
+                sample_sizes = [sample_size]
+            else:
+                ooms_fwd = sum(ooms_fwd)
+                ooms_bwd = sum(ooms_bwd)
 
             # aggregate stats and logging outputs
             ntokens = sum(log.get('ntokens', 0) for log in logging_outputs)
@@ -240,26 +292,160 @@ class ChildTrainer:
                     oom = 1
                     if hasattr(th.cuda, 'empty_cache'):
                         th.cuda.empty_cache()
-                    self.zero_grad()
+                    if self._grad_reducer is not None and self._grad_reducer.active:
+                        # [NOTE]: Buckets launched before OOM are already summed into other processes, so do not
+                        # zero their results, or this process will step with different gradients. Contribute zeros
+                        # to the rest buckets instead, then all processes run the same collectives and updates.
+                        self._grad_reducer.discard()
+                    else:
+                        self.zero_grad()
                 else:
                     raise e
         return oom
 
     def _all_reduce_and_scale(self, grad_denom):
-        # flatten grads into a single buffer and all-reduce
-        flat_grads = self._flat_grads = self._get_flat_grads(self._flat_grads)
-        if UseFairseqParallel and self.hparams.distributed_world_size > 1:
+        if self._grad_reducer is not None:
+            # gradients are all-reduced in buckets during backward, wait for them
+            self._grad_reducer.wait()
+        if self._flat_grads_buffer is not None:
+            # gradients are views of the flat buffer, work on it in place
+            flat_grads = self._flat_grads_buffer
+        else:
+            # flatten grads into a single buffer
+            flat_grads = self._flat_grads = self._get_flat_grads(self._flat_grads)
+        if distributed_utils.is_multiprocess() and self._grad_reducer is None:
             th.distributed.all_reduce(flat_grads)
 
         # rescale and clip gradients
         flat_grads.div_(grad_denom)
         grad_norm = common.clip_grad_norm_(flat_grads, self.hparams.clip_norm)
 
-        # copy grads back into model parameters
-        self._set_flat_grads(flat_grads)
+        if self._flat_grads_buffer is None:
+            # copy grads back into model parameters
+            self._set_flat_grads(flat_grads)
 
         return grad_norm
 
+    def _flatten_params(self, pad_to=1):
+        """Move parameters and gradients into two contiguous buffers, and make them views of the buffers.
+
+        Then gradients are all-reduced, scaled and clipped in place without copies.
+        Must be called after the model is moved to its device, and before the optimizer is built.
+
+        Args:
+            pad_to: Pad the buffers with zeros to a multiple of it (to split them into equal shards).
+
+        Returns:
+            bool: The model is flattened or not.
+        """
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        if not params:
+            return False
+        if len({(p.dtype, p.device) for p in params}) > 1:
+            logging.warning('Parameters have different types or devices, --flat-params is disabled')
+            return False
+        if self.cuda and any(isinstance(m, nn.RNNBase) for m in self.model.modules()):
+            # [NOTE]: cuDNN RNN layers move their weights into their own flat buffers.
+            logging.warning('Model contains RNN layers, --flat-params is disabled on GPU')
+            return False
+
+        total_size = sum(p.numel() for p in params)
+        flat_params = params[0].data.new_zeros(math.ceil(total_size / pad_to) * pad_to)
+        flat_grads = params[0].data.new_zeros(flat_params.numel())
+        offset = 0
+        for p in params:
+            numel = p.numel()
+            flat_params[offset:offset + numel].copy_(p.data.view(-1))
+            p.data = flat_params[offset:offset + numel].view_as(p)
+            p.grad = flat_grads[offset:offset + numel].view_as(p)
+            offset += numel
+        self._flat_params_buffer = flat_params
+        self._flat_grads_buffer = flat_grads
+        logging.info('Flat parameters: {} tensors, {} elements'.format(len(params), total_size))
+        return True
+
+    def _shard_params(self):
+        """Split the flat parameter buffer into one contiguous shard for each process (ZeRO-1).
+
+        The optimizer of each process only holds the state of its own shard (a parameter that is a view of the
+        flat buffer), updates it, then updated shards are all-gathered into the flat buffers of all processes.
+        """
+        world_size, rank = th.distributed.get_world_size(), th.distributed.get_rank()
+        shard_size = self._flat_params_buffer.numel() // world_size
+        self._param_shards = [
+            self._flat_params_buffer[i * shard_size:(i + 1) * shard_size]
+            for i in range(world_size)
+        ]
+        self._optim_shard = nn.Parameter(self._param_shards[rank])
+        self._optim_shard.grad = self._flat_grads_buffer[rank * shard_size:(rank + 1) * shard_size]
+        logging.info('Optimizer state shard: {} of {} elements'.format(shard_size, self._flat_params_buffer.numel()))
+
+    def _get_optim_params(self):
+        if self._optim_shard is not None:
+            return [self._optim_shard]
+        return self.model.parameters()
+
+    def _consolidate_optim_state(self):
+        """Gather the sharded optimizer state to the master, and convert it into the state dict of an unsharded
+        optimizer. Other processes only send their shards and return None.
+        """
+        is_master = th.distributed.get_rank() == 0
+        state_dict = self.optimizer.state_dict()
+        assert len(state_dict['param_groups']) == 1, 'Sharded optimizer must have one parameter group'
+        shard_state = state_dict['state'].get(state_dict['param_groups'][0]['params'][0], {})
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        total_size = sum(p.numel() for p in params)
+
+        state = {i: {} for i in range(len(params))} if shard_state else {}
+        for key in sorted(shard_state):
+            value = shard_state[key]
+            if th.is_tensor(value) and value.dim() > 0:
+                shards = [th.empty_like(value) for _ in self._param_shards] if is_master else None
+                th.distributed.gather(value, gather_list=shards, dst=0)
+                if not is_master:
+                    continue
+                flat_value = th.cat(shards)[:total_size]
+                offset = 0
+                for i, p in enumerate(params):
+                    state[i][key] = flat_value[offset:offset + p.numel()].view_as(p)
+                    offset += p.numel()
+            elif is_master:
+                # Scalars (e.g. number of steps) are same in all shards.
+                for i in range(len(params)):
+                    state[i][key] = value
+        if not is_master:
+            return None
+        param_group = dict(state_dict['param_groups'][0], params=list(range(len(params))))
+        return {'state': state, 'param_groups': [param_group]}
+
+    def _shard_optim_state(self, state_dict):
+        """Convert the state dict of an unsharded optimizer (see ``_consolidate_optim_state``) into the shard of
+        this process."""
+        assert len(state_dict['param_groups']) == 1, 'Sharded optimizer must have one parameter group'
+        param_ids = state_dict['param_groups'][0]['params']
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        assert len(param_ids) == len(params), 'Number of parameters does not match the optimizer state'
+        param_states = [state_dict['state'].get(i, {}) for i in param_ids]
+
+        shard_state = {}
+        rank = th.distributed.get_rank()
+        shard_size = self._optim_shard.numel()
+        for key in sorted(set(chain.from_iterable(param_states))):
+            values = [s.get(key) for s in param_states]
+            first = next(v for v in values if v is not None)
+            if th.is_tensor(first) and first.dim() > 0:
+                flat_value = self._flat_params_buffer.new_zeros(self._flat_params_buffer.numel())
+                offset = 0
+                for p, value in zip(params, values):
+                    if value is not None:
+                        flat_value[offset:offset + p.numel()].copy_(value.view(-1))
+                    offset += p.numel()
+                shard_state[key] = flat_value[rank * shard_size:(rank + 1) * shard_size].clone()
+            else:
+                shard_state[key] = first
+        param_group = dict(state_dict['param_groups'][0], params=[0])
+        return {'state': {0: shard_state} if shard_state else {}, 'param_groups': [param_group]}
+
     def _get_grads(self):
         grads = []
         for name, p in self.model.named_parameters():
@@ -294,6 +480,10 @@ class ChildTrainer:
     def _opt(self):
         # take an optimization step
         self.optimizer.step()
+        if self._optim_shard is not None:
+            self._consolidated_optim_state = None
+            # all-gather the updated parameter shards
+            th.distributed.all_gather(self._param_shards, self._optim_shard.data.clone())
         self.zero_grad()
         self._num_updates += 1
 
@@ -309,10 +499,9 @@ class ChildTrainer:
         assert not oom_fwd, 'Ran out of memory during validation'
 
         # gather logging outputs from all GPUs
-        if UseFairseqParallel and self.hparams.distributed_world_size > 1:
-            sample_sizes, logging_outputs = zip(*distributed_utils.all_gather_list(
-                (sample_size, logging_output)
-            ))
+        if distributed_utils.is_multiprocess():
+            logging_outputs, sample_sizes = distributed_utils.all_reduce_logging_outputs(
+                [logging_output], [sample_size])
         else:
             sample_sizes = [sample_size]
             logging_outputs = [logging_output]
@@ -336,7 +525,11 @@ class ChildTrainer:
         return self.lr_scheduler.step(epoch, val_loss)
 
     def zero_grad(self):
-        self.optimizer.zero_grad()
+        if self._flat_grads_buffer is not None:
+            # [NOTE]: Gradients must stay views of the flat buffer, so do not let the optimizer reset them to None.
+            self._flat_grads_buffer.zero_()
+        else:
+            self.optimizer.zero_grad()
 
     def clear_buffered_stats(self):
         self._buffered_stats.clear()
@@ -374,13 +567,13 @@ class ChildTrainer:
     def _prepare_sample(self, sample, volatile):
         if sample is None or len(sample) == 0:
             return None
-        if hasattr(th.cuda, 'empty_cache'):
+        if self.cuda and hasattr(th.cuda, 'empty_cache'):
             # Clear the caching allocator if this is the largest sample we've seen
             if sample['target'].size(0) > self._max_bsz_seen:
                 self._max_bsz_seen = sample['target'].size(0)
                 th.cuda.empty_cache()
 
-        return common.make_variable(sample, volatile=volatile, cuda=True)
+        return common.make_variable(sample, volatile=volatile, cuda=self.cuda)
 
     @property
     def single_gpu(self):
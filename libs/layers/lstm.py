@@ -165,7 +165,7 @@ class LSTMLayer(ChildLayer):
         if lengths is None:
             lengths = th.full([batch_size], max_length, dtype=th.int64)
 
-        return batched_index_select(data, get_reversed_index(lengths, max_length), dim=batch_dim)
+        return batched_index_select(data, get_reversed_index(lengths, max_length, device=data.device), dim=batch_dim)
 
     def extra_repr(self):
         return 'reversed={}'.format(self.reversed)
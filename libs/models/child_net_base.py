@@ -444,7 +444,7 @@ class ChildDecoderBase(nn.Module):
         if self.hparams.time_first:
             enc_hidden = enc_hidden.transpose(0, 1)
         max_length = enc_hidden.size(1)
-        src_mask = common.mask_from_lengths(src_lengths, left_pad=False, max_length=max_length, cuda=True)
+        src_mask = common.mask_from_lengths(src_lengths, left_pad=False, max_length=max_length)
 
         return (th.sum(enc_hidden * src_mask.unsqueeze(dim=2).type_as(enc_hidden), dim=1) /
                 src_lengths.unsqueeze(dim=1).type_as(enc_hidden))
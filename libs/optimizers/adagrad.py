@@ -22,7 +22,9 @@ class Adagrad(BaseOptimizer):
         resume training using a different set of optimizer args, e.g., with a
         different learning rate.
         """
-        return {
+        config = {
             'lr': self.hparams.lr[0],
             'weight_decay': self.hparams.weight_decay,
         }
+        config.update(self._multi_tensor_config(optim.Adagrad))
+        return config
@@ -7,11 +7,12 @@ import torch
 import torch.optim
 
 from . import BaseOptimizer, register_optimizer
+from .base import FlatStateMixin
 
 __author__ = 'fyabc'
 
 
-class _Adam(torch.optim.Optimizer):
+class _Adam(FlatStateMixin, torch.optim.Optimizer):
     """Implements Adam algorithm.
 
     This implementation is modified from torch.optim.Adam based on:
@@ -31,6 +32,8 @@ class _Adam(torch.optim.Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
+        fused (boolean, optional): update each parameter group with vectorized
+            ops on flat state buffers, see ``FlatStateMixin`` (default: False)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -39,9 +42,9 @@ class _Adam(torch.optim.Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, fused=False):
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad, fused=fused)
         super().__init__(params, defaults)
 
     def step(self, closure=None):
@@ -55,7 +58,12 @@ class _Adam(torch.optim.Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        for index, group in enumerate(self.param_groups):
+            if group.get('fused', False) and self._fusable(group) and \
+                    len({self.state[p].get('step', 0) for p in group['params']}) == 1:
+                self._fused_step(index, group)
+                continue
+
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -106,6 +114,47 @@ class _Adam(torch.optim.Optimizer):
 
         return loss
 
+    def _fused_step(self, index, group):
+        """Update all parameters of the group on the flat state buffers."""
+        params = group['params']
+        amsgrad = group['amsgrad']
+        for p in params:
+            state = self.state[p]
+            state['step'] = state.get('step', 0) + 1
+        step = self.state[params[0]]['step']
+        flat_state = self._get_flat_state(
+            index, group, ['exp_avg', 'exp_avg_sq'] + (['max_exp_avg_sq'] if amsgrad else []))
+        flat_params, flat_grads = self._get_flat_params_and_grads(flat_state, params)
+        beta1, beta2 = group['betas']
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+        if 'denom' not in flat_state:
+            flat_state['denom'] = flat_params.new_empty(min(flat_params.numel(), self.CPUChunkSize)
+                                                        if not flat_params.is_cuda else flat_params.numel())
+
+        flat_tensors = [flat_params, flat_grads, flat_state['exp_avg'], flat_state['exp_avg_sq']]
+        if amsgrad:
+            flat_tensors.append(flat_state['max_exp_avg_sq'])
+        for chunk in self._iter_chunks(*flat_tensors):
+            p, grad, exp_avg, exp_avg_sq = chunk[:4]
+            denom = flat_state['denom'][:p.numel()]
+
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            if amsgrad:
+                max_exp_avg_sq = chunk[4]
+                torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+                torch.sqrt(max_exp_avg_sq, out=denom).add_(group['eps'])
+            else:
+                torch.sqrt(exp_avg_sq, out=denom).add_(group['eps'])
+
+            if group['weight_decay'] != 0:
+                p.add_(p, alpha=-group['weight_decay'] * group['lr'])
+
+            p.addcdiv_(exp_avg, denom, value=-step_size)
+        self._set_flat_params(flat_state, params, flat_params)
+
 
 @register_optimizer('adam')
 class Adam(BaseOptimizer):
@@ -134,4 +183,5 @@ class Adam(BaseOptimizer):
             'betas': eval(self.hparams.adam_betas),
             'eps': self.hparams.adam_eps,
             'weight_decay': self.hparams.weight_decay,
+            'fused': getattr(self.hparams, 'fused_optim', False),
         }
@@ -1,11 +1,113 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
 
+import inspect
+
+import torch
 import torch.optim
 
 __author__ = 'fyabc'
 
 
+def _storage(tensor):
+    return tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+
+
+def flat_view(tensors):
+    """Get a flat view of tensors if they are adjacent in the same storage in order (e.g. with --flat-params),
+    else return None."""
+    if not tensors:
+        return None
+    first = tensors[0]
+    storage_ptr = _storage(first).data_ptr()
+    ptr = first.data_ptr()
+    for t in tensors:
+        if t.dtype != first.dtype or t.device != first.device or not t.is_contiguous() or \
+                t.data_ptr() != ptr or _storage(t).data_ptr() != storage_ptr:
+            return None
+        ptr += t.numel() * t.element_size()
+    if len(tensors) == 1:
+        return first.view(-1)
+    return first.new_empty(0).set_(_storage(first), first.storage_offset(), (sum(t.numel() for t in tensors),))
+
+
+class FlatStateMixin:
+    """Mixin of ``torch.optim.Optimizer`` to keep the state of each parameter group in flat buffers (--fused-optim).
+
+    State tensors of each parameter are views of the flat buffers of its group, so a fused step runs a handful of
+    vectorized ops on the whole group, and the state dict is same as the unfused one (checkpoints are compatible).
+    Parameters and gradients are used in place if they are views of flat buffers (--flat-params), else they are
+    gathered into (and parameters scattered back from) flat buffers of the group.
+    """
+
+    # [NOTE]: On CPU, run the vectorized ops on chunks of flat buffers that fit in the cache.
+    CPUChunkSize = 32768
+
+    def _get_flat_state(self, index, group, keys):
+        flat_states = self.__dict__.setdefault('_flat_states', {})
+        if index not in flat_states:
+            params = group['params']
+            total_size = sum(p.numel() for p in params)
+            flat_state = {'params': flat_view([p.data for p in params])}
+            for key in keys:
+                buffer = params[0].data.new_zeros(total_size)
+                offset = 0
+                for p in params:
+                    numel = p.numel()
+                    view = buffer[offset:offset + numel].view_as(p.data)
+                    state = self.state[p]
+                    if key in state:
+                        view.copy_(state[key])
+                    state[key] = view
+                    offset += numel
+                flat_state[key] = buffer
+            flat_states[index] = flat_state
+        return flat_states[index]
+
+    def _iter_chunks(self, *flat_tensors):
+        """Iterate over chunks of flat tensors, yield tuples of views of them."""
+        total_size = flat_tensors[0].numel()
+        chunk_size = total_size if flat_tensors[0].is_cuda else self.CPUChunkSize
+        for start in range(0, total_size, chunk_size):
+            yield tuple(t[start:start + chunk_size] for t in flat_tensors)
+
+    @staticmethod
+    def _fusable(group):
+        """Test if all parameters of the group have dense gradients."""
+        return all(p.grad is not None and not p.grad.is_sparse for p in group['params'])
+
+    @staticmethod
+    def _get_flat_params_and_grads(flat_state, params):
+        flat_params = flat_state['params']
+        if flat_params is None:
+            if 'param_buffer' not in flat_state:
+                flat_state['param_buffer'] = params[0].data.new_empty(sum(p.numel() for p in params))
+            flat_params = torch.cat([p.data.view(-1) for p in params], out=flat_state['param_buffer'])
+        grads = [p.grad.data for p in params]
+        flat_grads = flat_view(grads)
+        if flat_grads is None:
+            if 'grad_buffer' not in flat_state:
+                flat_state['grad_buffer'] = grads[0].new_empty(sum(g.numel() for g in grads))
+            flat_grads = torch.cat([g.view(-1) for g in grads], out=flat_state['grad_buffer'])
+        return flat_params, flat_grads
+
+    @staticmethod
+    def _set_flat_params(flat_state, params, flat_params):
+        if flat_state['params'] is not None:
+            # Parameters are updated in place.
+            return
+        offset = 0
+        for p in params:
+            numel = p.numel()
+            p.data.copy_(flat_params[offset:offset + numel].view_as(p.data))
+            offset += numel
+
+    def load_state_dict(self, state_dict):
+        # [NOTE]: Loaded state tensors are not views of the flat buffers, rebuild them in the next step.
+        self.__dict__['_flat_states'] = {}
+        super().load_state_dict(state_dict)
+
+
 class BaseOptimizer:
     def __init__(self, hparams, params):
         super().__init__()
@@ -36,6 +138,13 @@ class BaseOptimizer:
         """
         raise NotImplementedError
 
+    def _multi_tensor_config(self, optimizer_cls):
+        """Use the multi-tensor (foreach) implementation of a builtin optimizer with --fused-optim, if supported."""
+        if getattr(self.hparams, 'fused_optim', False) and \
+                'foreach' in inspect.signature(optimizer_cls.__init__).parameters:
+            return {'foreach': True}
+        return {}
+
     def get_lr(self):
         """Return the current learning rate."""
         return self.optimizer.param_groups[0]['lr']
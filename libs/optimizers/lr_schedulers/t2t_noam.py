@@ -23,7 +23,8 @@ class T2TNoamSchedule(BaseLRScheduler):
         if hparams.warmup_init_lr < 0:
             hparams.warmup_init_lr = warmup_end_lr
 
-        self.warmup_updates = float(self.hparams.warmup_updates * th.cuda.device_count())
+        num_devices = hparams.distributed_world_size if getattr(hparams, 'cpu', False) else th.cuda.device_count()
+        self.warmup_updates = float(self.hparams.warmup_updates * num_devices)
         self.decay_factor = 5000.0 * hparams.src_embedding_size ** -0.5
 
         self.lr_base = self.hparams.lr[0]
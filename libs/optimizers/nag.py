@@ -4,13 +4,14 @@
 from torch.optim.optimizer import Optimizer, required
 
 from . import BaseOptimizer, register_optimizer
+from .base import FlatStateMixin
 
 __author__ = 'fyabc'
 
 
-class _NAG(Optimizer):
-    def __init__(self, params, lr=required, momentum=0, weight_decay=0):
-        defaults = dict(lr=lr, lr_old=lr, momentum=momentum, weight_decay=weight_decay)
+class _NAG(FlatStateMixin, Optimizer):
+    def __init__(self, params, lr=required, momentum=0, weight_decay=0, fused=False):
+        defaults = dict(lr=lr, lr_old=lr, momentum=momentum, weight_decay=weight_decay, fused=fused)
         super().__init__(params, defaults)
 
     def step(self, closure=None):
@@ -24,13 +25,30 @@ class _NAG(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        for index, group in enumerate(self.param_groups):
             weight_decay = group['weight_decay']
             momentum = group['momentum']
             lr = group['lr']
             lr_old = group.get('lr_old', lr)
             lr_correct = lr / lr_old
 
+            if group.get('fused', False) and self._fusable(group):
+                # Update all parameters of the group on the flat state buffers.
+                params = group['params']
+                flat_state = self._get_flat_state(index, group, ['momentum_buffer'])
+                flat_params, flat_grads = self._get_flat_params_and_grads(flat_state, params)
+                for p, d_p, buf in self._iter_chunks(flat_params, flat_grads, flat_state['momentum_buffer']):
+                    if weight_decay != 0:
+                        p.mul_(1 - lr * weight_decay)
+                    p.add_(buf, alpha=momentum * momentum * lr_correct)
+                    p.add_(d_p, alpha=-(1 + momentum) * lr)
+
+                    buf.mul_(momentum * lr_correct).add_(d_p, alpha=-lr)
+                self._set_flat_params(flat_state, params, flat_params)
+
+                group['lr_old'] = lr
+                continue
+
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -72,4 +90,5 @@ class NAG(BaseOptimizer):
             'lr': self.hparams.lr[0],
             'momentum': self.hparams.momentum,
             'weight_decay': self.hparams.weight_decay,
+            'fused': getattr(self.hparams, 'fused_optim', False),
         }
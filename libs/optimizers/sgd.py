@@ -22,8 +22,10 @@ class SGD(BaseOptimizer):
         resume training using a different set of optimizer args, e.g., with a
         different learning rate.
         """
-        return {
+        config = {
             'lr': self.hparams.lr[0],
             'momentum': self.hparams.momentum,
             'weight_decay': self.hparams.weight_decay,
         }
+        config.update(self._multi_tensor_config(optim.SGD))
+        return config
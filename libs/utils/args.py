@@ -14,6 +14,13 @@ from ..criterions import AllCriterions
 __author__ = 'fyabc'
 
 
+def _add_cpu_arg(group, help):
+    """Add the ``--cpu`` option shared by training and generation, once for parsers that have both groups."""
+    # [NOTE]: Argument groups share the option table of their parser.
+    if '--cpu' not in group._option_string_actions:
+        group.add_argument('--cpu', action='store_true', default=False, help=help)
+
+
 def add_general_args(parser):
     group = parser.add_argument_group('General Options', description='General options.')
     group.add_argument('--log-level', dest='logging_level', type=str, default='INFO', metavar='LEVEL',
@@ -34,6 +41,10 @@ def add_general_args(parser):
                        help='Enable batch first mode, default is time first mode')
     group.add_argument('--time-first', action='store_true', default=True,
                        help='Enable time first mode, default is %(default)r')
+    group.add_argument('--num-threads', type=int, default=None, metavar='N',
+                       help='Number of intra-op threads of PyTorch on CPU, default is the PyTorch default')
+    group.add_argument('--num-interop-threads', type=int, default=None, metavar='N',
+                       help='Number of inter-op threads of PyTorch on CPU, default is the PyTorch default')
     return group
 
 
@@ -107,6 +118,10 @@ def add_dataset_args(parser, train=False, gen=False):
                        help='maximum number of tokens in a batch')
     group.add_argument('--skip-invalid-size-inputs-valid-test', action='store_true',
                        help='Ignore too long or too short lines in valid and test set')
+    group.add_argument('--batch-cache-dir', default=None, type=str, metavar='DIR',
+                       help='Directory to persist frozen batch plans, default is "$DATA_DIR/$TASK/batch_cache/"')
+    group.add_argument('--no-batch-cache', action='store_true', default=False,
+                       help='Do not persist frozen batch plans')
     if train:
         group.add_argument('--train-subset', default='train', metavar='SPLIT',
                            choices=['train', 'dev', 'test'],
@@ -117,6 +132,32 @@ def add_dataset_args(parser, train=False, gen=False):
         group.add_argument('--max-sentences-valid', type=int, metavar='N',
                            help='maximum number of sentences in a validation batch'
                                 ' (defaults to --max-sentences)')
+        group.add_argument('--collate-buffers', default=0, type=int, metavar='N',
+                           help='Collate training batches into a ring of N reusable pinned buffers,'
+                                ' default is %(default)s (allocate new tensors for each batch)')
+        group.add_argument('--num-workers', default=0, type=int, metavar='N',
+                           help='Number of processes to load training batches, default is %(default)s')
+        group.add_argument('--prefetch', default=0, type=int, metavar='N',
+                           help='Number of training batches loaded ahead in background, default is %(default)s')
+        group.add_argument('--pin-memory', action='store_true', default=False,
+                           help='Load training batches into pinned memory')
+        group.add_argument('--batch-planner', default='sorted', choices=['sorted', 'bucket'],
+                           help='How to plan training batches: sorted by lengths, or inside 2-D length buckets'
+                                ' to reduce padding (default: %(default)s)')
+        group.add_argument('--num-length-buckets', default=16, type=int, metavar='N',
+                           help='Number of source and target length buckets of the bucket planner,'
+                                ' default is %(default)s')
+        group.add_argument('--min-length', default=1, type=int, metavar='N',
+                           help='Ignore training samples shorter than N tokens (EOS included), default is %(default)s')
+        group.add_argument('--max-length-ratio', default=None, type=float, metavar='R',
+                           help='Ignore training samples with source/target length ratio (or its inverse) larger'
+                                ' than R, default is no limit')
+        group.add_argument('--stream-shards', action='store_true', default=False,
+                           help='Stream the training subset from binarized shards (see "preprocess.py --shard-size")'
+                                ' instead of loading it into memory')
+        group.add_argument('--stream-window', default=1000000, type=int, metavar='N',
+                           help='Number of sentences shuffled and bucketed together when streaming,'
+                                ' default is %(default)s')
     if gen:
         group.add_argument('--gen-subset', default='test', metavar='SPLIT',
                            help='data subset to generate (train, valid, test)')
@@ -124,6 +165,13 @@ def add_dataset_args(parser, train=False, gen=False):
                            help='shard generation over N shards')
         group.add_argument('--shard-id', default=0, type=int, metavar='ID',
                            help='id of the shard to generate (id < num_shards)')
+        group.add_argument('--input-file', default=None, metavar='FILE',
+                           help='Translate this raw text file ("-" means stdin) instead of the data subset')
+        group.add_argument('--input-buffer-size', default=10000, type=int, metavar='N',
+                           help='Number of input lines tokenized and sorted by length together,'
+                                ' default is %(default)s')
+        group.add_argument('--input-workers', default=1, type=int, metavar='N',
+                           help='Number of background threads to tokenize the input, default is %(default)s')
     return group
 
 
@@ -137,6 +185,14 @@ def add_train_args(parser):
         criterion.add_args(group)
     group.add_argument('--max-epoch', '--me', default=0, type=int, metavar='N',
                        help='force stop training at specified epoch, default is inf')
+    _add_cpu_arg(group, help='Train (or generate) on CPU, see also --num-threads and --num-interop-threads')
+    group.add_argument('--flat-params', action='store_true', default=False,
+                       help='Store parameters and gradients in contiguous buffers, to all-reduce, scale and clip'
+                            ' gradients in place (unused parameters are not detected)')
+    group.add_argument('--fused-optim', action='store_true', default=False,
+                       help='Update each parameter group of Adam and NAG with a few vectorized ops on flat state'
+                            ' buffers (fastest with --flat-params), use the foreach implementation of other'
+                            ' optimizers if supported')
     group.add_argument('--max-update', '--mu', default=0, type=int, metavar='N',
                        help='force stop training at specified update, default is inf')
     group.add_argument('--sentence-avg', action='store_true', default=False,
@@ -189,6 +245,22 @@ def add_distributed_args(parser):
                        help='port number (not required if using --distributed-init-method)')
     group.add_argument('--device-id', type=int, default=0, metavar='N',
                        help='GPU device id, usually automatically set')
+    group.add_argument('--cpu-workers', type=int, default=0, metavar='N',
+                       help='With --cpu, train with N processes over the gloo backend, each pinned to its own group'
+                            ' of cores (--num-threads defaults to the group size), default is %(default)s'
+                            ' (single process)')
+    group.add_argument('--bucket-all-reduce', action='store_true', default=False,
+                       help='In multi-process training, all-reduce gradients in buckets asynchronously during'
+                            ' backward (all parameters must be used in the forward pass)')
+    group.add_argument('--all-reduce-bucket-mb', type=float, default=10, metavar='MB',
+                       help='Size of the buckets of --bucket-all-reduce in MB, default is %(default)s')
+    group.add_argument('--shard-optim-state', action='store_true', default=False,
+                       help='In multi-process training, each process only holds and updates the optimizer state of'
+                            ' its own shard of parameters, then all-gathers updated parameters (ZeRO-1, requires'
+                            ' --flat-params), checkpoints are saved with consolidated state')
+    group.add_argument('--shard-strategy', default='round_robin', choices=['round_robin', 'balanced'],
+                       help='How to assign training batches to ranks: round_robin, or balanced by padded tokens'
+                            ' (default: %(default)s)')
     return group
 
 
@@ -232,14 +304,15 @@ def add_generation_args(parser):
                              'where x is the source length'))
     # TODO: This option need test
     group.add_argument('--use-task-maxlen', default=False, action='store_true',
-                       help='use maxlen information in the task')
+                       help='use maxlen measured in the dataset statistics (see "parse_dataset.py"),'
+                            ' or the length information in the task')
     group.add_argument('--no-early-stop', action='store_true',
                        help=('continue searching even after finalizing k=beam '
                              'hypotheses; this is more correct, but increases '
                              'generation time by 50%%'))
     group.add_argument('--unnormalized', action='store_true',
                        help='compare unnormalized hypothesis scores')
-    group.add_argument('--cpu', action='store_true', help='generate on CPU')
+    _add_cpu_arg(group, help='generate on CPU')
     group.add_argument('--no-beamable-mm', action='store_true',
                        help='don\'t use BeamableMM in attention layers')
     group.add_argument('--lenpen', default=1, type=float,
@@ -260,6 +333,10 @@ def add_generation_args(parser):
                        help='Translation output directory, default is "$PROJECT/translated/"')
     group.add_argument('--output-file', default=None, type=str, metavar='FILE',
                        help='Translation output filename, default is None (does not output)')
+    group.add_argument('--resume-output', action='store_true', default=False,
+                       help='Keep the translations already in the output file, and only translate the rest')
+    group.add_argument('--output-fsync-interval', default=30.0, type=float, metavar='SECONDS',
+                       help='Seconds between syncing the output file to disk, default is %(default)s')
     group.add_argument('--model-overrides', default="{}", type=str, metavar='DICT',
                        help='a dictionary used to override model args at generation that were used during model '
                             'training')
@@ -27,7 +27,15 @@ def torch_persistent_save(*args, **kwargs):
 
 
 def save_state(filename, hparams, model, criterion, optimizer, lr_scheduler,
-               num_updates, optim_history=None, extra_state=None, net_code=None):
+               num_updates, optim_history=None, extra_state=None, net_code=None, optimizer_state=None):
+    """Save the training state.
+
+    Args:
+        optimizer_state: Optimizer state dict to save instead of ``optimizer.state_dict()``,
+            e.g. the consolidated state of sharded optimizers.
+    """
+    if optimizer_state is None:
+        optimizer_state = optimizer.state_dict()
     if optim_history is None:
         optim_history = []
     if extra_state is None:
@@ -43,23 +51,30 @@ def save_state(filename, hparams, model, criterion, optimizer, lr_scheduler,
                 'num_updates': num_updates,
             }
         ],
-        'last_optimizer_state': optimizer.state_dict(),
+        'last_optimizer_state': optimizer_state,
         'net_code': net_code,
         'extra_state': extra_state,
     }
     torch_persistent_save(state_dict, filename)
 
 
-def load_model_state(filename, model, cuda_device=None):
+def load_model_state(filename, model, cuda_device=None, cpu=False):
+    """Load model parameters from a checkpoint file.
+
+    Tensors are loaded to ``cuda_device`` if it is given, else to CPU if ``cpu`` is set (e.g. with ``--cpu``),
+    else to the devices they are saved on.
+    """
     if not os.path.exists(filename):
         return None, [], None
-    if cuda_device is None:
-        state = th.load(filename)
-    else:
+    if cuda_device is not None:
         state = th.load(
             filename,
             map_location=lambda s, l: default_restore_location(s, 'cuda:{}'.format(cuda_device))
         )
+    elif cpu:
+        state = th.load(filename, map_location=lambda s, l: s)
+    else:
+        state = th.load(filename)
     state = _upgrade_state_dict(state)
     state['model'] = model.upgrade_state_dict(state['model'])
 
@@ -226,7 +241,7 @@ def make_positions(tensor, padding_idx, left_pad):
         # because tensor and buffer must be on the same GPU device.
         if not hasattr(make_positions, 'range_buf_dict'):
             make_positions.range_buf_dict = {}
-        device_id = th.cuda.current_device()
+        device_id = tensor.device
         if device_id not in make_positions.range_buf_dict:
             make_positions.range_buf_dict[device_id] = tensor.new()
         make_positions.range_buf_dict[device_id] = make_positions.range_buf_dict[device_id].type_as(tensor)
@@ -241,14 +256,14 @@ def make_positions(tensor, padding_idx, left_pad):
     return tensor.clone().masked_scatter_(mask, positions[mask])
 
 
-def mask_from_lengths(lengths, left_pad, max_length=None, cuda=False):
+def mask_from_lengths(lengths, left_pad, max_length=None, cuda=None):
     """Create mask from length array.
 
     Args:
         lengths (Tensor): (batch_size,) of int64
         left_pad (bool):
         max_length (int):
-        cuda (bool):
+        cuda (bool): Create the mask on GPU or CPU, default is on the device of lengths.
 
     Returns:
         Tensor
@@ -258,9 +273,12 @@ def mask_from_lengths(lengths, left_pad, max_length=None, cuda=False):
         lengths_ = lengths.data
     else:
         lengths_ = lengths
+    lengths_ = th.as_tensor(lengths_, dtype=th.int64)
+    if cuda is not None:
+        lengths_ = lengths_.cuda() if cuda else lengths_.cpu()
     batch_size = len(lengths_)
 
-    _ml = max(lengths_)
+    _ml = int(lengths_.max())
     if max_length is None:
         max_length = _ml
     else:
@@ -268,20 +286,15 @@ def mask_from_lengths(lengths, left_pad, max_length=None, cuda=False):
         # so add the argument `max_length` to set it directly.
         if _ml > max_length:
             raise RuntimeError('Max length is less than the maximum value in lengths')
-    if cuda:
-        tensor_type = th.cuda.ByteTensor
+    positions = th.arange(max_length, dtype=th.int64, device=lengths_.device).unsqueeze(0)
+    if left_pad:
+        result = positions >= (max_length - lengths_).unsqueeze(1)
     else:
-        tensor_type = th.ByteTensor
-    result = tensor_type(batch_size, max_length).fill_(0)
+        result = positions < lengths_.unsqueeze(1)
+    result = result.to(th.uint8).view(batch_size, max_length)
     if isinstance(lengths, Variable):
         result = Variable(result, requires_grad=lengths.requires_grad)
 
-    for i, length in enumerate(lengths_):
-        if left_pad:
-            result[i, max_length - length:] = 1
-        else:
-            result[i, :length] = 1
-
     return result
 
 
@@ -311,7 +324,7 @@ def pad_and_subsequent_mask(lengths, in_encoder, apply_subsequent_mask=False, ma
     from .data_processing import LanguagePairDataset
 
     left_pad = LanguagePairDataset.LEFT_PAD_SOURCE if in_encoder else LanguagePairDataset.LEFT_PAD_TARGET
-    mask = mask_from_lengths(lengths, left_pad=left_pad, max_length=maxlen, cuda=True)
+    mask = mask_from_lengths(lengths, left_pad=left_pad, max_length=maxlen)
 
     # Same mask applied to whole query sequence.
     mask = mask.unsqueeze(1)
@@ -320,7 +333,7 @@ def pad_and_subsequent_mask(lengths, in_encoder, apply_subsequent_mask=False, ma
     if apply_subsequent_mask:
         mask = mask & make_variable(
             subsequent_mask(maxlen),
-            cuda=True,
+            cuda=mask.is_cuda,
         )
 
     # Same mask applied to all h heads.
@@ -410,13 +423,16 @@ def clip_grad_norm_(tensor, max_norm):
     return grad_norm
 
 
-def get_reversed_index(lengths, max_length):
-    return th.stack([
-        th.cat([
-            th.arange(l - 1, -1, -1, dtype=th.int64).cuda(),
-            th.arange(l, max_length, 1, dtype=th.int64).cuda(),
-        ])
-        for l in lengths])
+def get_reversed_index(lengths, max_length, device=None):
+    """Get the index that reverses the first ``length`` elements of each row, on the device of lengths by default.
+
+    Returns:
+        Tensor
+        (batch_size, max_length) of int64
+    """
+    lengths = th.as_tensor(lengths, dtype=th.int64, device=device).unsqueeze(1)
+    positions = th.arange(max_length, dtype=th.int64, device=lengths.device).unsqueeze(0)
+    return th.where(positions < lengths, lengths - 1 - positions, positions)
 
 
 def batched_index_select(input_, index, dim=0):
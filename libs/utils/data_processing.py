@@ -26,11 +26,30 @@ Dict format: pickled dict
     Notes:
         Contains 3 special tokens: padding '<pad>' = 0, eos '</s>' = 1, unknown '<unk>' = 2.
 
+Binarized format:
+    Each text file can be binarized into ``<filename>.bin`` and ``<filename>.idx`` (see ``indexed_dataset.py``).
+    If the binarized files exist and are newer than the text file, they are memory-mapped instead of
+    tokenizing the text file.
+    With ``--stream-shards``, the training split is streamed from binarized shards ``<filename>.<shard-id>``
+    instead (see ``ShardedLanguagePairDataset``).
+
 """
 
+import array
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import logging
 import math
+import mmap
 import os
 import numbers
+import queue
+import sys
+import threading
+import time
+from types import SimpleNamespace
 
 import numpy as np
 import torch as th
@@ -39,9 +58,11 @@ from torch.utils.data import Dataset, DataLoader
 from .paths import get_data_path
 from .dictionary import Dictionary
 from ..tasks import get_task
-from .tokenizer import Tokenizer
+from .tokenizer import Tokenizer, tokenize_line
 from .common import numpy_seed
-from . import UseFairseqParallel
+from . import indexed_dataset
+from . import dataset_stats
+from . import distributed_utils
 
 __author__ = 'fyabc'
 
@@ -54,6 +75,23 @@ class LanguageDatasets:
 
         self.dataset_dir = get_data_path(hparams)
 
+        # Directory to store frozen batch plans.
+        if getattr(hparams, 'no_batch_cache', False):
+            self.batch_cache_dir = None
+        else:
+            self.batch_cache_dir = getattr(hparams, 'batch_cache_dir', None) or \
+                os.path.join(self.dataset_dir, 'batch_cache')
+
+        # Splits streamed from binarized shards instead of loaded into memory.
+        if getattr(hparams, 'stream_shards', False):
+            self.stream_splits = {getattr(hparams, 'train_subset', 'train')}
+        else:
+            self.stream_splits = set()
+        self.stream_window = getattr(hparams, 'stream_window', 1000000)
+
+        # Dataset statistics computed by "parse_dataset.py", None if not available.
+        self.stats = dataset_stats.load_stats(dataset_stats.stats_file_path(self.dataset_dir, self.task))
+
         # Load dictionary.
         self.source_dict = Dictionary(
             os.path.join(self.dataset_dir, self.task.get_filename('dict', is_src_lang=True)),
@@ -66,32 +104,94 @@ class LanguageDatasets:
                          max_sentences=None, max_positions=(1024, 1024),
                          seed=None, epoch=1, sample_without_replacement=0,
                          sort_by_source_size=False, shard_id=0, num_shards=1,
-                         start=None, end=None):
+                         start=None, end=None, collate_buffers=0,
+                         num_workers=0, prefetch=0, pin_memory=False, batch_offset=0,
+                         shard_strategy='round_robin', planner='sorted', num_length_buckets=16,
+                         min_length=1, max_ratio=None):
+        """Get the training data loader.
+
+        Batches are always yielded in the order of the (frozen) batch plan, whatever the number of workers.
+
+        Args:
+            collate_buffers: Collate into a ring of reusable pinned buffers of this size, 0 to disable.
+                Ignored when ``num_workers > 0``.
+            num_workers: Number of ``DataLoader`` worker processes.
+            prefetch: Number of batches loaded ahead by a background thread, 0 to load synchronously.
+            pin_memory: Copy batches into pinned memory (only if CUDA is available).
+            batch_offset: Start at this batch of the epoch (to resume mid-epoch). Skipped batches are
+                dropped from the batch plan, they are not loaded or collated.
+            shard_strategy: How to assign batches to distributed ranks, see ``mask_batches``.
+                Not used by streaming datasets, which assign windows to ranks.
+            planner: Batch planner, see ``LanguagePairDataset.shuffled_batches_by_size``.
+            num_length_buckets: Number of length buckets of source and target for the 'bucket' planner.
+            min_length: Ignore samples shorter than this (EOS included).
+            max_ratio: Ignore samples with source / target length ratio (or its inverse) larger than this.
+
+        Returns:
+            PrefetchLoader, the length is the number of remaining batches.
+        """
         # [NOTE]: If use DataParallel, must only load as single process.
-        if not UseFairseqParallel:
+        if not distributed_utils.is_multiprocess():
             shard_id, num_shards = 0, 1
 
         dataset = self.get_dataset(split)
 
+        if isinstance(dataset, ShardedLanguagePairDataset):
+            if start is not None or end is not None or sample_without_replacement:
+                raise ValueError('Streaming dataset does not support start, end or sample without replacement')
+            if num_workers > 0:
+                logging.warning('Streaming dataset is loaded in the main process, ignore num_workers')
+            return PrefetchLoader(StreamingBatchIterator(
+                dataset, max_tokens=max_tokens, max_sentences=max_sentences, max_positions=max_positions,
+                seed=seed, epoch=epoch, shuffle=not sort_by_source_size,
+                shard_id=shard_id, num_shards=num_shards, batch_offset=batch_offset,
+                min_length=min_length, max_ratio=max_ratio,
+                buffers=CollateBuffers(num_slots=max(collate_buffers, prefetch + 2)) if collate_buffers > 0 else None,
+            ), prefetch=prefetch)
+
         batch_sampler = dataset.shuffled_batches_by_size(
             max_tokens=max_tokens,
             max_sentences=max_sentences, epoch=epoch,
             sample=sample_without_replacement, max_positions=max_positions,
-            sort_by_source_size=sort_by_source_size, seed=seed, start=start, end=end)
-        batch_sampler = mask_batches(batch_sampler, shard_id=shard_id, num_shards=num_shards)
-
-        return DataLoader(
-            dataset, collate_fn=dataset.collater,
-            batch_sampler=batch_sampler,
+            sort_by_source_size=sort_by_source_size, seed=seed, start=start, end=end,
+            planner=planner, num_length_buckets=num_length_buckets,
+            length_boundaries=dataset_stats.bucket_boundaries(self.stats, split, num_length_buckets),
+            min_length=min_length, max_ratio=max_ratio)
+        if shard_id == 0:
+            src_padding, trg_padding = dataset.padding_ratio(batch_sampler)
+            logging.info('Epoch {} batch plan ({} planner): {} batches, padding ratio: source {:.2%}, '
+                         'target {:.2%}'.format(epoch, planner, len(batch_sampler), src_padding, trg_padding))
+        batch_sampler = mask_batches(
+            batch_sampler, shard_id=shard_id, num_shards=num_shards, strategy=shard_strategy,
+            sizes=(dataset.src.sizes, dataset.trg.sizes),
+            seed=None if seed is None else seed + epoch, shuffle=not sort_by_source_size)
+        batch_sampler = batch_sampler[batch_offset:]
+
+        collate_fn = dataset.collate_indices
+        if collate_buffers > 0:
+            if num_workers > 0:
+                logging.warning('Collate buffers cannot be shared from DataLoader workers, disabled')
+            else:
+                # [NOTE]: Batches waiting in the prefetch queue must not be overwritten.
+                collate_fn = functools.partial(dataset.collate_indices, buffers=CollateBuffers(
+                    num_slots=max(collate_buffers, prefetch + 2)))
+
+        # [NOTE]: Collate each batch from its indices at once, ``batch_size=None`` disables automatic batching.
+        loader = DataLoader(
+            BatchDataset(dataset, batch_sampler, collate_fn=collate_fn),
+            batch_size=None, collate_fn=_identity,
+            num_workers=num_workers,
+            pin_memory=pin_memory and th.cuda.is_available(),
         )
+        return PrefetchLoader(loader, prefetch=prefetch)
 
     def eval_dataloader(self, split, num_workers=0, max_tokens=None,
                         max_sentences=None, max_positions=(1024, 1024),
                         skip_invalid_size_inputs_valid_test=False,
                         descending=False, shard_id=0, num_shards=1,
-                        repeat=1, sort_by_length=True):
+                        repeat=1, sort_by_length=True, start_id=0):
         # [NOTE]: If use DataParallel, must only load as single process.
-        if not UseFairseqParallel:
+        if not distributed_utils.is_multiprocess():
             shard_id, num_shards = 0, 1
 
         dataset = self.get_dataset(split)
@@ -100,12 +200,12 @@ class LanguageDatasets:
             max_tokens=max_tokens, max_sentences=max_sentences,
             max_positions=max_positions,
             ignore_invalid_inputs=skip_invalid_size_inputs_valid_test,
-            descending=descending, repeat=repeat, sort_by_length=sort_by_length)
+            descending=descending, repeat=repeat, sort_by_length=sort_by_length, start_id=start_id)
         batch_sampler = mask_batches(batch_sampler, shard_id=shard_id, num_shards=num_shards)
 
         return DataLoader(
-            dataset, num_workers=num_workers,
-            collate_fn=dataset.collater, batch_sampler=batch_sampler,
+            BatchDataset(dataset, batch_sampler), num_workers=num_workers,
+            batch_size=None, collate_fn=_identity,
         )
 
     def get_dataset(self, split_name):
@@ -115,24 +215,53 @@ class LanguageDatasets:
             split_name: Name of the split to load.
 
         Returns:
-            LanguagePairDataset
+            LanguagePairDataset, or ShardedLanguagePairDataset if the split is streamed.
         """
-        if split_name not in self.splits:
+        if split_name not in self.splits and split_name in self.stream_splits:
+            src_prefix = os.path.join(self.dataset_dir, self.task.get_filename(split_name, is_src_lang=True))
+            trg_prefix = os.path.join(self.dataset_dir, self.task.get_filename(split_name, is_src_lang=False))
+            self.splits[split_name] = ShardedLanguagePairDataset(
+                indexed_dataset.list_shards(src_prefix),
+                indexed_dataset.list_shards(trg_prefix),
+                self.source_dict, self.target_dict,
+                pad_id=self.source_dict.pad_id,
+                eos_id=self.source_dict.eos_id,
+                window_size=self.stream_window,
+            )
+        elif split_name not in self.splits:
             src_path = os.path.join(self.dataset_dir, self.task.get_filename(split_name, is_src_lang=True))
             trg_path = os.path.join(self.dataset_dir, self.task.get_filename(split_name, is_src_lang=False))
             self.splits[split_name] = LanguagePairDataset(
-                TextDataset(src_path, self.source_dict),
-                TextDataset(trg_path, self.target_dict),
+                _load_text_dataset(src_path, self.source_dict),
+                _load_text_dataset(trg_path, self.target_dict),
                 pad_id=self.source_dict.pad_id,
                 eos_id=self.source_dict.eos_id,
+                cache_dir=self.batch_cache_dir,
+                filter_path=filter_file_path(self.dataset_dir, self.task, split_name),
             )
 
         return self.splits[split_name]
 
+    def get_maxlen_a_b(self):
+        """Get the factors a & b of target length in generation, measured from the dataset statistics if available.
+
+        trg_length = a * src_length + b
+        """
+        result = dataset_stats.maxlen_a_b(self.stats)
+        if result is None:
+            return self.task.get_maxlen_a_b()
+        return result
+
     def load_splits(self, splits):
         for split in splits:
             self.get_dataset(split)
 
+    def share_memory(self):
+        """Share loaded splits between processes, see ``TextDataset.share_memory``."""
+        for dataset in self.splits.values():
+            dataset.share_memory()
+        return self
+
 
 class ShardedIterator:
     def __init__(self, itr, num_shards, shard_id):
@@ -150,42 +279,186 @@ class ShardedIterator:
                 yield v
 
 
+class LineReader:
+    """Read lines of a text file on demand.
+
+    The byte-offset index of lines is built at the first access, then lines are read through a memory map,
+    so the raw text is never held in memory.
+    """
+
+    # Scan the file in chunks of this size when building the index.
+    ChunkSize = 1 << 26
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        self._starts = None
+        self._ends = None
+
+    def __getstate__(self):
+        # [NOTE]: Memory map cannot be pickled, rebuild the index in other processes.
+        return {'path': self.path, '_mmap': None, '_starts': None, '_ends': None}
+
+    def __len__(self):
+        self._build_index()
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        self._build_index()
+        line = self._mmap[self._starts[index]:self._ends[index]].decode('utf-8')
+        if line.endswith('\r'):
+            line = line[:-1]
+        return line
+
+    def _build_index(self):
+        if self._starts is not None:
+            return
+
+        with open(self.path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size > 0 else b''
+
+        newlines = [np.empty(0, dtype=np.int64)]
+        for chunk_start in range(0, file_size, self.ChunkSize):
+            chunk = np.frombuffer(self._mmap, dtype=np.uint8, offset=chunk_start,
+                                  count=min(self.ChunkSize, file_size - chunk_start))
+            newlines.append(np.flatnonzero(chunk == ord('\n')) + chunk_start)
+        ends = np.concatenate(newlines)
+        if file_size > 0 and (len(ends) == 0 or ends[-1] != file_size - 1):
+            # Last line without newline.
+            ends = np.append(ends, file_size)
+        self._starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)[:len(ends)]
+        self._ends = ends
+
+
 class TextDataset:
+    """Text dataset, tokenized into a single flat token buffer.
+
+    Tokens of sentence ``i`` are ``buffer[offsets[i]:offsets[i + 1]]``, stored in the smallest dtype
+    that fits the vocabulary. ``__getitem__`` returns zero-copy tensor views of the buffer.
+    """
     def __init__(self, path, dictionary, append_eos=True, reverse_order=False):
-        self.tokens_list = []
-        self.lines = []
-        self.sizes = []
+        self.buffer = None
+        self.offsets = None
+        self.lines = LineReader(path)
+        self.sizes = None
         self.append_eos = append_eos
         self.reverse_order = reverse_order
-        self.read_data(path, dictionary)
-        self.size = len(self.tokens_list)
         self.dictionary = dictionary
+        self.read_data(path, dictionary)
+        self.size = len(self.sizes)
 
     def __len__(self):
         return self.size
 
     def __getitem__(self, index):
         self.check_index(index)
-        return self.tokens_list[index]
+        return th.from_numpy(self.buffer[self.offsets[index]:self.offsets[index + 1]])
 
     def check_index(self, i):
         if i < 0 or i >= self.size:
             raise IndexError('index out of range')
 
     def read_data(self, path, dictionary):
+        dtype = np.dtype(indexed_dataset.best_dtype(len(dictionary)))
+        buffer = array.array(dtype.char)
+        sizes = array.array('q')
         with open(path, 'r', encoding='utf-8') as f:
             for line in f:
-                self.lines.append(line.strip('\n'))
                 tokens = Tokenizer.tokenize(line, dictionary, add_if_not_exist=False,
                                             append_eos=self.append_eos, reverse_order=self.reverse_order)
-                self.tokens_list.append(tokens)
-                self.sizes.append(len(tokens))
-        self.sizes = np.array(self.sizes)
+                buffer.extend(tokens.tolist())
+                sizes.append(len(tokens))
+        self.buffer = np.frombuffer(buffer, dtype=dtype) if len(buffer) > 0 else np.empty(0, dtype=dtype)
+        self.sizes = np.frombuffer(sizes, dtype=np.int64) if len(sizes) > 0 else np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.offsets[1:])
 
     def get_original_text(self, index):
         self.check_index(index)
         return self.lines[index]
 
+    _ArrayNames = ('buffer', 'offsets', 'sizes')
+
+    def share_memory(self):
+        """Move the token buffer, offsets and sizes into shared memory.
+
+        Then pickling the dataset (e.g. when passed to spawned processes) only sends handles of the shared memory,
+        and all processes use the same copy of the data.
+        """
+        for name in self._ArrayNames:
+            array_ = getattr(self, name)
+            if not isinstance(array_, th.Tensor):
+                array_ = th.from_numpy(np.ascontiguousarray(array_)).share_memory_()
+            setattr(self, name, array_.numpy())
+            setattr(self, '_shared_' + name, array_)
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if '_shared_buffer' in state:
+            # [NOTE]: Send the shared tensors, the NumPy views are rebuilt from them.
+            for name in self._ArrayNames:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_shared_buffer' in state:
+            for name in self._ArrayNames:
+                setattr(self, name, state['_shared_' + name].numpy())
+
+
+class IndexedTextDataset(TextDataset):
+    """Text dataset memory-mapped from binarized files.
+
+    Same interface as ``TextDataset``, but does not tokenize the text file.
+    """
+    def __init__(self, path, dictionary):
+        self.path = path
+        dtype, self.offsets, self.sizes = indexed_dataset.read_index(indexed_dataset.index_file_path(path))
+        self.buffer = indexed_dataset.read_data(
+            indexed_dataset.data_file_path(path), dtype, int(self.offsets[-1]))
+        self.lines = LineReader(path) if os.path.exists(path) else None
+        self.size = len(self.sizes)
+        self.dictionary = dictionary
+
+    def share_memory(self):
+        # [NOTE]: Memory-mapped pages are already shared between processes.
+        return self
+
+    def __getstate__(self):
+        # Pickle by path, and memory map the files again when unpickled.
+        state = self.__dict__.copy()
+        for name in self._ArrayNames:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        dtype, self.offsets, self.sizes = indexed_dataset.read_index(indexed_dataset.index_file_path(self.path))
+        self.buffer = indexed_dataset.read_data(
+            indexed_dataset.data_file_path(self.path), dtype, int(self.offsets[-1]))
+
+    def get_original_text(self, index):
+        if self.lines is None:
+            # [NOTE]: Text file is not available, rebuild the text from tokens (unknown words are lost).
+            self.check_index(index)
+            return self.dictionary.string(self[index])
+        return super().get_original_text(index)
+
+
+def _load_text_dataset(path, dictionary):
+    """Load the memory-mapped dataset if the binarized files are available, else tokenize the text file."""
+    if indexed_dataset.dataset_exists(path):
+        if os.path.exists(path) and \
+                os.path.getmtime(path) > os.path.getmtime(indexed_dataset.index_file_path(path)):
+            logging.warning('Binarized files of {!r} are older than the text file, ignore them'.format(path))
+        else:
+            logging.info('Load binarized dataset {!r}'.format(path))
+            return IndexedTextDataset(path, dictionary)
+    return TextDataset(path, dictionary)
+
 
 class LanguagePairDataset(Dataset):
     """Language pair dataset.
@@ -199,7 +472,7 @@ class LanguagePairDataset(Dataset):
     LEFT_PAD_SOURCE = False     # True in fairseq-py
     LEFT_PAD_TARGET = False
 
-    def __init__(self, src, trg, pad_id, eos_id):
+    def __init__(self, src, trg, pad_id, eos_id, cache_dir=None, filter_path=None):
         self.src = src
         self.trg = trg
         self.src_dict = self.src.dictionary
@@ -210,9 +483,36 @@ class LanguagePairDataset(Dataset):
         self.frozen_batches_dict = {}
         self.frozen_batches = None
 
+        # Frozen batches are also persisted into this directory, None means do not persist.
+        self.cache_dir = cache_dir
+        self._fingerprint = None
+
+        # Precomputed masks of valid samples, see ``valid_mask``.
+        self.filter_path = filter_path
+        self._valid_masks = {}
+
     def __len__(self):
         return len(self.src)
 
+    def valid_mask(self, max_positions, min_length=1, max_ratio=None):
+        """Get the mask of valid samples, computed once for each filter.
+
+        Loaded from ``filter_path`` (see "preprocess.py --filter-max-positions") if it is built with the same filter.
+        """
+        key = _filter_key(max_positions, min_length, max_ratio)
+        mask = self._valid_masks.get(key, None)
+        if mask is None:
+            mask = load_filter(self.filter_path, len(self), *key)
+            if mask is None:
+                mask = _valid_size_mask(
+                    self.src.sizes, self.trg.sizes if self.trg is not None else self.src.sizes, *key)
+            num_invalid = len(mask) - int(np.count_nonzero(mask))
+            if num_invalid > 0:
+                logging.warning('{} samples are either too short, too long or of too large length ratio, '
+                                'and will be ignored'.format(num_invalid))
+            self._valid_masks[key] = mask
+        return mask
+
     def __getitem__(self, index):
         source = self.src[index]
         result = {
@@ -225,9 +525,11 @@ class LanguagePairDataset(Dataset):
 
     def batches_by_size(self, max_tokens=None, max_sentences=None,
                         max_positions=(1024, 1024), ignore_invalid_inputs=False,
-                        descending=False, repeat=1, sort_by_length=True):
+                        descending=False, repeat=1, sort_by_length=True, start_id=0):
         """Returns batches of indices sorted by size. Sequences with different
         source lengths are not allowed in the same batch.
+
+        Samples before ``start_id`` are excluded (e.g. already translated).
         """
         if max_tokens is None:
             max_tokens = float('Inf')
@@ -237,11 +539,13 @@ class LanguagePairDataset(Dataset):
             indices = np.argsort(self.src.sizes, kind='mergesort')
         else:
             indices = np.arange(len(self), dtype=np.int64)
+        if start_id > 0:
+            indices = indices[indices >= start_id]
         if descending:
             indices = np.flip(indices, 0)
 
         allow_different_src_lens = False if sort_by_length else True
-        single_result = list(_make_batches(
+        single_result = list(_make_batches_fast(
             self.src, self.trg, indices, max_tokens, max_sentences, max_positions,
             ignore_invalid_inputs, allow_different_src_lens=allow_different_src_lens))
         result = single_result
@@ -251,9 +555,21 @@ class LanguagePairDataset(Dataset):
 
     def shuffled_batches_by_size(self, max_tokens=None, max_sentences=None,
                                  epoch=1, sample=0, max_positions=(1024, 1024),
-                                 sort_by_source_size=False, seed=1, start=None, end=None):
+                                 sort_by_source_size=False, seed=1, start=None, end=None,
+                                 planner='sorted', num_length_buckets=16, length_boundaries=None,
+                                 min_length=1, max_ratio=None):
         """Returns batches of indices, bucketed by size and then shuffled. Batches
-        may contain sequences of different lengths."""
+        may contain sequences of different lengths.
+
+        Planners:
+            'sorted': Sort by target size and then by source size, and cut the sorted indices into batches.
+            'bucket': Split samples into 2-D (source, target) length buckets with boundaries at the quantiles
+                of each length histogram, then batch each bucket separately, see ``_make_bucket_batches``.
+                The boundaries can be given by ``length_boundaries`` (e.g. from the dataset statistics).
+
+        Samples out of ``max_positions``, shorter than ``min_length`` or with length ratio larger than ``max_ratio``
+        are removed with the precomputed ``valid_mask`` before batching.
+        """
         if max_tokens is None:
             max_tokens = float('Inf')
         if max_sentences is None:
@@ -264,18 +580,38 @@ class LanguagePairDataset(Dataset):
         if end is None:
             end = len(self.src)
 
-        if self.frozen_batches_dict.get((start, end), None) is None:
-            with numpy_seed(seed):
-                indices = np.random.permutation(end - start) + start
-
-            # sort by sizes
-            indices = indices[np.argsort(self.trg.sizes[indices], kind='mergesort')]
-            indices = indices[np.argsort(self.src.sizes[indices], kind='mergesort')]
-
-            self.frozen_batches_dict[(start, end)] = list(_make_batches(
-                self.src, self.trg, indices, max_tokens, max_sentences, max_positions,
-                ignore_invalid_inputs=True, allow_different_src_lens=True))
-        frozen_batches = self.frozen_batches_dict[(start, end)]
+        # [NOTE]: The batch plan is cached in memory and on disk by all arguments that change it.
+        plan_key = self._batch_plan_key(
+            'shuffled', seed, max_tokens, max_sentences, max_positions, start, end,
+            *(() if planner == 'sorted' else (planner, num_length_buckets)),
+            *(() if planner == 'sorted' or length_boundaries is None else (length_boundaries,)),
+            *(() if (min_length, max_ratio) == (1, None) else (min_length, max_ratio)))
+        if self.frozen_batches_dict.get(plan_key, None) is None:
+            cache_path = self._batch_cache_path(plan_key)
+            frozen_batches = _load_batches(cache_path)
+
+            if frozen_batches is None:
+                with numpy_seed(seed):
+                    indices = np.random.permutation(end - start) + start
+                indices = indices[self.valid_mask(max_positions, min_length, max_ratio)[indices]]
+
+                if planner == 'bucket':
+                    frozen_batches = _make_bucket_batches(
+                        self.src, self.trg, indices, max_tokens, max_sentences, max_positions,
+                        num_buckets=num_length_buckets, boundaries=length_boundaries)
+                elif planner == 'sorted':
+                    # sort by sizes
+                    indices = indices[np.argsort(self.trg.sizes[indices], kind='mergesort')]
+                    indices = indices[np.argsort(self.src.sizes[indices], kind='mergesort')]
+
+                    frozen_batches = list(_make_batches_fast(
+                        self.src, self.trg, indices, max_tokens, max_sentences, max_positions,
+                        ignore_invalid_inputs=True, allow_different_src_lens=True))
+                else:
+                    raise ValueError('Unknown batch planner {!r}'.format(planner))
+                _save_batches(cache_path, frozen_batches)
+            self.frozen_batches_dict[plan_key] = frozen_batches
+        frozen_batches = self.frozen_batches_dict[plan_key]
 
         with numpy_seed(seed + epoch):
             batches = list(frozen_batches)
@@ -300,9 +636,103 @@ class LanguagePairDataset(Dataset):
 
         return batches
 
-    def collater(self, samples):
+    def padding_ratio(self, batches):
+        """Get the padding ratio (padded tokens / real tokens) of source and target of the batches."""
+        return (
+            _padding_ratio(batches, self.src.sizes),
+            _padding_ratio(batches, self.trg.sizes) if self.trg is not None else None,
+        )
+
+    def share_memory(self):
+        self.src.share_memory()
+        if self.trg is not None:
+            self.trg.share_memory()
+        return self
+
+    def fingerprint(self):
+        """Get the fingerprint of sentence sizes. Batch plans only depend on sizes."""
+        if self._fingerprint is None:
+            md5 = hashlib.md5()
+            md5.update(np.ascontiguousarray(self.src.sizes, dtype=np.int64).tobytes())
+            if self.trg is not None:
+                md5.update(np.ascontiguousarray(self.trg.sizes, dtype=np.int64).tobytes())
+            self._fingerprint = md5.hexdigest()
+        return self._fingerprint
+
+    @staticmethod
+    def _batch_plan_key(kind, seed, *args):
+        """Get the hashable key of a batch plan, lists and arrays (e.g. length boundaries) are converted into tuples."""
+        def _hashable(a):
+            if isinstance(a, (list, tuple, np.ndarray)):
+                return tuple(_hashable(b) for b in a)
+            if isinstance(a, np.generic):
+                return a.item()
+            return a
+        return (kind, seed) + _hashable(args)
+
+    def _batch_cache_path(self, plan_key):
+        """Get the filename of the persisted batch plan, or None if it should not be persisted."""
+        kind, seed = plan_key[:2]
+        if self.cache_dir is None or seed is None:
+            return None
+        key = repr((kind, self.fingerprint(), seed) + plan_key[2:])
+        return os.path.join(self.cache_dir, 'batches.{}.npz'.format(hashlib.md5(key.encode()).hexdigest()))
+
+    def collater(self, samples, buffers=None):
         """Used by DataLoader. Merges a list of samples to form a mini-batch."""
-        return self.collate(samples, self.pad_id, self.eos_id, self.trg is not None)
+        return self.collate_indices([s['id'] for s in samples], buffers=buffers)
+
+    def collate_indices(self, indices, buffers=None):
+        """Vectorized version of ``collate``, gather the samples from the flat token buffers.
+
+        Indices are sorted by descending source length before gathering, and source, target and
+        shifted target are built with NumPy fancy indexing in one pass.
+
+        Args:
+            indices: List of sample indices.
+            buffers (CollateBuffers): Reusable output buffers, None to allocate new tensors.
+
+        Returns:
+            dict: Same as ``collate``.
+        """
+        if len(indices) == 0:
+            return {}
+
+        slot = buffers.next_slot() if buffers is not None else None
+
+        indices = np.asarray(indices, dtype=np.int64)
+        # sort by descending source length
+        indices = indices[np.argsort(-self.src.sizes[indices], kind='mergesort')]
+        src_lengths = np.asarray(self.src.sizes[indices], dtype=np.int64)
+        src_tokens, _ = _gather_tokens(
+            self.src, indices, src_lengths, self.pad_id, self.eos_id, self.LEFT_PAD_SOURCE)
+
+        trg_tokens = None
+        trg_tokens_train = None
+        trg_lengths = None
+        ntokens = None
+        if self.trg is not None:
+            trg_lengths = np.asarray(self.trg.sizes[indices], dtype=np.int64)
+            trg_tokens, trg_tokens_train = _gather_tokens(
+                self.trg, indices, trg_lengths, self.pad_id, self.eos_id, self.LEFT_PAD_TARGET,
+                move_eos_to_beginning=True,     # Target for training, left shift.
+            )
+            ntokens = int(trg_lengths.sum())
+            trg_tokens = _to_tensor(trg_tokens, buffers, slot, 'trg_tokens')
+            trg_tokens_train = _to_tensor(trg_tokens_train, buffers, slot, 'trg_tokens_train')
+            trg_lengths = th.from_numpy(trg_lengths)
+
+        return {
+            'id': th.from_numpy(indices),
+            'ntokens': ntokens,
+            'net_input': {
+                'src_tokens': _to_tensor(src_tokens, buffers, slot, 'src_tokens'),
+                'src_lengths': th.from_numpy(src_lengths),
+                'trg_tokens': trg_tokens_train,
+                'trg_lengths': trg_lengths,
+            },
+            'target': trg_tokens,
+        }
 
     @staticmethod
     def collate(samples, pad_id, eos_id, has_target=True):
@@ -354,7 +784,8 @@ class LanguagePairDataset(Dataset):
     @staticmethod
     def collate_tokens(values, pad_id, eos_id, left_pad, move_eos_to_beginning=False):
         size = max(v.size(0) for v in values)
-        res = values[0].new(len(values), size).fill_(pad_id)
+        # [NOTE]: Values may be views of compact token buffers, always collate them into int64.
+        res = values[0].new(len(values), size).long().fill_(pad_id)
 
         def copy_tensor(src, trg):
             assert trg.numel() == src.numel()
@@ -378,14 +809,512 @@ class LanguagePairDataset(Dataset):
         max_source_positions, max_target_positions = max_positions
         src_len, tgt_len = min(src_len, max_source_positions), min(tgt_len, max_target_positions)
         bsz = num_tokens // max(src_len, tgt_len)
-        return self.collater([
+        return self.collate([
             {
                 'id': i,
                 'source': self.src_dict.dummy_sentence(src_len),
                 'target': self.trg_dict.dummy_sentence(tgt_len) if self.trg_dict is not None else None,
             }
             for i in range(bsz)
-        ])
+        ], self.pad_id, self.eos_id, self.trg is not None)
+
+
+class ShardedLanguagePairDataset:
+    """Language pair dataset streamed from binarized shards, for corpora larger than the memory.
+
+    Shards (see ``indexed_dataset.shard_prefix``) are memory-mapped one at a time. Sentences are only
+    shuffled and bucketed by length inside windows of ``window_size`` sentences, and windows are dealt to
+    distributed ranks in turn, so no global index is built.
+    """
+
+    def __init__(self, src_prefixes, trg_prefixes, src_dict, trg_dict, pad_id, eos_id, window_size=1000000):
+        if not src_prefixes:
+            raise FileNotFoundError('No binarized shards found, run "preprocess.py --shard-size N" first')
+        if len(src_prefixes) != len(trg_prefixes):
+            raise ValueError('Source and target have different number of shards: {} vs {}'.format(
+                len(src_prefixes), len(trg_prefixes)))
+        self.src_prefixes = src_prefixes
+        self.trg_prefixes = trg_prefixes
+        self.src_dict = src_dict
+        self.trg_dict = trg_dict
+        self.pad_id = pad_id
+        self.eos_id = eos_id
+        self.window_size = window_size
+
+        self.shard_lengths = []
+        for src_prefix, trg_prefix in zip(src_prefixes, trg_prefixes):
+            src_length = len(indexed_dataset.read_index(indexed_dataset.index_file_path(src_prefix))[2])
+            trg_length = len(indexed_dataset.read_index(indexed_dataset.index_file_path(trg_prefix))[2])
+            if src_length != trg_length:
+                raise ValueError('Shard {!r} has different source and target lengths: {} vs {}'.format(
+                    src_prefix, src_length, trg_length))
+            self.shard_lengths.append(src_length)
+
+        # Cached number of batches of each window, see ``window_num_batches``.
+        self._num_batches = {}
+
+    def __len__(self):
+        return sum(self.shard_lengths)
+
+    def get_shard(self, shard_id):
+        return LanguagePairDataset(
+            IndexedTextDataset(self.src_prefixes[shard_id], self.src_dict),
+            IndexedTextDataset(self.trg_prefixes[shard_id], self.trg_dict),
+            pad_id=self.pad_id, eos_id=self.eos_id,
+        )
+
+    def get_windows(self, seed, epoch):
+        """Get all windows of the epoch, list of (shard id, start, end). Shards are visited in shuffled order."""
+        with numpy_seed(None if seed is None else seed + epoch):
+            shard_order = np.random.permutation(len(self.shard_lengths))
+        return [
+            (shard_id, start, min(start + self.window_size, self.shard_lengths[shard_id]))
+            for shard_id in shard_order
+            for start in range(0, self.shard_lengths[shard_id], self.window_size)
+        ]
+
+    @staticmethod
+    def window_batches(shard, window, max_tokens, max_sentences, max_positions, seed=None, epoch=1, shuffle=True,
+                       min_length=1, max_ratio=None):
+        """Make batches of a window, same as ``LanguagePairDataset.shuffled_batches_by_size`` on the window.
+
+        Args:
+            shard (LanguagePairDataset): The shard of the window.
+            window: (shard id, start, end).
+        """
+        shard_id, start, end = window
+        if max_tokens is None:
+            max_tokens = float('Inf')
+        if max_sentences is None:
+            max_sentences = float('Inf')
+
+        with numpy_seed(None if seed is None else (seed, epoch, shard_id, start)):
+            indices = np.random.permutation(end - start) + start
+
+            # [NOTE]: Skip invalid sizes here, or every window will warn about them.
+            indices = indices[_valid_size_mask(
+                shard.src.sizes[indices], shard.trg.sizes[indices], max_positions, min_length, max_ratio)]
+
+            # sort by sizes
+            indices = indices[np.argsort(shard.trg.sizes[indices], kind='mergesort')]
+            indices = indices[np.argsort(shard.src.sizes[indices], kind='mergesort')]
+
+            batches = list(_make_batches_fast(
+                shard.src, shard.trg, indices, max_tokens, max_sentences, max_positions,
+                ignore_invalid_inputs=True, allow_different_src_lens=True))
+            if shuffle:
+                np.random.shuffle(batches)
+        return batches
+
+    def window_num_batches(self, windows, max_tokens, max_sentences, max_positions, min_length=1, max_ratio=None):
+        """Get the number of batches of each window, same as ``len(window_batches(...))`` of any seed and epoch.
+
+        [NOTE]: Windows are sorted by sizes before they are cut into batches, so the number of batches does not
+        depend on the shuffling. It is computed from the sizes in the index files once, and cached for all epochs.
+        """
+        key = (max_tokens, max_sentences, tuple(max_positions), min_length, max_ratio)
+        num_batches = self._num_batches.setdefault(key, {})
+        result = []
+        for window in windows:
+            if window not in num_batches:
+                num_batches.update(self._count_shard_batches(window[0], *key))
+            result.append(num_batches[window])
+        return result
+
+    def _count_shard_batches(self, shard_id, max_tokens, max_sentences, max_positions, min_length, max_ratio):
+        """Count batches of all windows of a shard, only the sizes are read from the index files."""
+        if max_tokens is None:
+            max_tokens = float('Inf')
+        if max_sentences is None:
+            max_sentences = float('Inf')
+        src_sizes, trg_sizes = (
+            np.asarray(indexed_dataset.read_index(indexed_dataset.index_file_path(prefixes[shard_id]))[2])
+            for prefixes in (self.src_prefixes, self.trg_prefixes))
+        result = {}
+        for start in range(0, self.shard_lengths[shard_id], self.window_size):
+            end = min(start + self.window_size, self.shard_lengths[shard_id])
+            src = SimpleNamespace(sizes=src_sizes[start:end])
+            trg = SimpleNamespace(sizes=trg_sizes[start:end])
+            indices = np.flatnonzero(_valid_size_mask(
+                src.sizes, trg.sizes, max_positions, min_length, max_ratio))
+            # Same order of sizes as ``window_batches``.
+            indices = indices[np.lexsort((trg.sizes[indices], src.sizes[indices]))]
+            result[shard_id, start, end] = sum(1 for _ in _make_batches_fast(
+                src, trg, indices, max_tokens, max_sentences, max_positions,
+                ignore_invalid_inputs=True, allow_different_src_lens=True))
+        return result
+
+    def share_memory(self):
+        # [NOTE]: Shards are memory-mapped when used, nothing to share.
+        return self
+
+    def get_dummy_batch(self, num_tokens, max_positions, src_len=128, tgt_len=128):
+        return self.get_shard(0).get_dummy_batch(num_tokens, max_positions, src_len=src_len, tgt_len=tgt_len)
+
+
+class StreamingBatchIterator:
+    """Iterate over collated batches of a ``ShardedLanguagePairDataset`` for one epoch.
+
+    Window ``k`` of the epoch is assigned to rank ``k % num_shards``. Ranks with fewer batches are padded
+    with empty batches, same as ``mask_batches``. The first ``batch_offset`` batches are skipped without
+    collating them.
+    [NOTE]: Sample ids of the batches are indices inside the shard.
+    """
+
+    def __init__(self, dataset, max_tokens=None, max_sentences=None, max_positions=(1024, 1024),
+                 seed=None, epoch=1, shuffle=True, shard_id=0, num_shards=1, batch_offset=0, buffers=None,
+                 min_length=1, max_ratio=None):
+        assert 0 <= shard_id < num_shards
+        self.dataset = dataset
+        self.max_tokens = max_tokens
+        self.max_sentences = max_sentences
+        self.max_positions = max_positions
+        self.min_length = min_length
+        self.max_ratio = max_ratio
+        self.seed = seed
+        self.epoch = epoch
+        self.shuffle = shuffle
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.batch_offset = batch_offset
+        self.buffers = buffers
+
+        self.windows = dataset.get_windows(seed, epoch)
+        self._epoch_length = None
+
+    def epoch_length(self):
+        """Number of batches of each rank in the epoch.
+
+        Summed from the cached number of batches of each window (see ``window_num_batches``), so windows are not
+        planned again in each epoch.
+        """
+        if self._epoch_length is None:
+            num_batches = self.dataset.window_num_batches(
+                self.windows, self.max_tokens, self.max_sentences, self.max_positions,
+                min_length=self.min_length, max_ratio=self.max_ratio)
+            rank_lengths = [0] * self.num_shards
+            for k, n in enumerate(num_batches):
+                rank_lengths[k % self.num_shards] += n
+            self._epoch_length = max(rank_lengths)
+        return self._epoch_length
+
+    def __len__(self):
+        return max(self.epoch_length() - self.batch_offset, 0)
+
+    def _iter_window_batches(self):
+        shard_id, shard = None, None
+        for k, window in enumerate(self.windows):
+            if k % self.num_shards != self.shard_id:
+                continue
+            if window[0] != shard_id:
+                shard_id, shard = window[0], self.dataset.get_shard(window[0])
+            yield shard, self.dataset.window_batches(
+                shard, window, self.max_tokens, self.max_sentences, self.max_positions,
+                seed=self.seed, epoch=self.epoch, shuffle=self.shuffle,
+                min_length=self.min_length, max_ratio=self.max_ratio)
+
+    def __iter__(self):
+        position = 0
+        for shard, batches in self._iter_window_batches():
+            skip = min(max(self.batch_offset - position, 0), len(batches))
+            for batch in batches[skip:]:
+                yield shard.collate_indices(batch, buffers=self.buffers)
+            position += len(batches)
+        for _ in range(max(position, self.batch_offset), self.epoch_length()):
+            yield {}
+
+
+class BatchDataset(Dataset):
+    """Dataset of batches of a language pair dataset, for ``DataLoader`` with ``batch_size=None``.
+
+    Each item is a batch collated by ``LanguagePairDataset.collate_indices`` from its list of indices,
+    so samples are never fetched one by one with ``__getitem__``.
+    """
+
+    def __init__(self, dataset, batches, collate_fn=None):
+        self.dataset = dataset
+        self.batches = batches
+        self.collate_fn = collate_fn if collate_fn is not None else dataset.collate_indices
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        return self.collate_fn(self.batches[index])
+
+
+def _identity(batch):
+    return batch
+
+
+class CollateBuffers:
+    """Reusable output buffers of ``LanguagePairDataset.collate_indices``.
+
+    Keeps a ring of ``num_slots`` sets of (pinned) buffers, each batch is written into the next slot.
+    [NOTE]: So a batch is only valid until ``num_slots`` more batches are collated.
+    Only use it in the main process, pinned memory cannot be shared from ``DataLoader`` workers.
+    """
+    def __init__(self, num_slots=2, pin_memory=True):
+        self.num_slots = num_slots
+        self.pin_memory = pin_memory and th.cuda.is_available()
+        self._slots = [{} for _ in range(num_slots)]
+        self._next_slot = 0
+
+    def next_slot(self):
+        slot = self._slots[self._next_slot]
+        self._next_slot = (self._next_slot + 1) % self.num_slots
+        return slot
+
+    def get(self, slot, name, shape):
+        numel = shape[0] * shape[1]
+        buffer = slot.get(name, None)
+        if buffer is None or buffer.numel() < numel:
+            buffer = th.LongTensor(numel)
+            if self.pin_memory:
+                buffer = buffer.pin_memory()
+            slot[name] = buffer
+        return buffer[:numel].view(*shape)
+
+
+class PrefetchLoader:
+    """Iterate over a data loader, optionally loading batches ahead in a background thread.
+
+    Also measures the time that the consumer is blocked waiting for batches.
+    """
+
+    _End = object()
+
+    def __init__(self, loader, prefetch=0):
+        self.loader = loader
+        self.prefetch = prefetch
+        self.wait_time = 0.0
+        self._start_time = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def wait_ratio(self):
+        """Fraction of the time since the iteration started that the consumer was blocked on loading."""
+        if self._start_time is None:
+            return 0.0
+        elapsed = time.time() - self._start_time
+        return self.wait_time / elapsed if elapsed > 0 else 0.0
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self._start_time = time.time()
+        if self.prefetch <= 0:
+            yield from self._iter_sync()
+        else:
+            yield from self._iter_prefetch()
+
+    def _iter_sync(self):
+        iterator = iter(self.loader)
+        while True:
+            start = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.time() - start
+            yield batch
+
+    def _iter_prefetch(self):
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batch_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                batch = batch_queue.get()
+                self.wait_time += time.time() - start
+                if batch is self._End:
+                    return
+                if isinstance(batch, _LoaderError):
+                    raise batch.exc
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def _produce(self, batch_queue, stop_event):
+        def _put(item):
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.loader:
+                if not _put(batch):
+                    return
+        except Exception as e:
+            _put(_LoaderError(e))
+            return
+        _put(self._End)
+
+
+class _ArrayTextDataset(TextDataset):
+    """Text dataset of token arrays in memory, see ``TextDataset``."""
+    def __init__(self, buffer, offsets, dictionary):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.sizes = np.diff(offsets)
+        self.lines = None
+        self.size = len(self.sizes)
+        self.dictionary = dictionary
+
+
+class RawInputIterator:
+    """Iterate over batches of source sentences read from a raw text file or stdin, for translation.
+
+    A reader thread reads the input in chunks of ``buffer_size`` lines, and a thread pool tokenizes each chunk,
+    sorts it by length, cuts it into batches and collates them, at most ``num_workers + 1`` chunks ahead
+    of the consumer. So tokenization runs while the previous chunks are being decoded.
+
+    Batches have no target. Sample ids are line numbers of the input (from 0), use them to restore the original
+    order of outputs. Every line gets a sample, lines longer than ``max_positions`` are truncated with a warning.
+    The first ``start_line`` lines (e.g. already translated) are read but skipped.
+    """
+
+    def __init__(self, path, dictionary, max_tokens=None, max_sentences=None, max_positions=1024,
+                 buffer_size=10000, num_workers=1, start_line=0):
+        self.path = path
+        self.dictionary = dictionary
+        self.max_tokens = float('Inf') if max_tokens is None else max_tokens
+        self.max_sentences = float('Inf') if max_sentences is None else max_sentences
+        self.max_positions = max_positions
+        self.buffer_size = buffer_size
+        self.num_workers = max(num_workers, 1)
+        self.start_line = start_line
+
+        # Number of lines read, available after the iteration.
+        self.num_lines = 0
+
+    def __iter__(self):
+        futures = queue.Queue(maxsize=self.num_workers + 1)
+        stop_event = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(self.num_workers) as executor:
+            reader = threading.Thread(target=self._read, args=(executor, futures, stop_event), daemon=True)
+            reader.start()
+            try:
+                while True:
+                    future = futures.get()
+                    if future is PrefetchLoader._End:
+                        return
+                    yield from future.result()
+            finally:
+                stop_event.set()
+                reader.join()
+                while not futures.empty():
+                    future = futures.get()
+                    if future is not PrefetchLoader._End:
+                        future.cancel()
+
+    def _read(self, executor, futures, stop_event):
+        def _put(item):
+            while not stop_event.is_set():
+                try:
+                    futures.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        start = 0
+        try:
+            f = sys.stdin if self.path == '-' else open(self.path, 'r', encoding='utf-8')
+            try:
+                start = sum(1 for _ in itertools.islice(f, self.start_line))
+                while True:
+                    lines = list(itertools.islice(f, self.buffer_size))
+                    if not lines:
+                        break
+                    if not _put(executor.submit(self._make_chunk_batches, lines, start)):
+                        return
+                    start += len(lines)
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+        except Exception as e:
+            error = concurrent.futures.Future()
+            error.set_exception(e)
+            _put(error)
+            return
+        self.num_lines = start
+        _put(PrefetchLoader._End)
+
+    def _make_chunk_batches(self, lines, start):
+        """Tokenize a chunk of lines, and get its collated batches in ascending order of source length."""
+        max_words = self.max_positions - 1     # EOS excluded
+        num_truncated = [0]
+
+        def _tokenize(line):
+            words = tokenize_line(line)
+            if len(words) > max_words:
+                num_truncated[0] += 1
+                return words[:max_words]
+            return words
+
+        ids, offsets = self.dictionary.encode_lines(lines, line_tokenizer=_tokenize)
+        ids = ids.astype(indexed_dataset.best_dtype(len(self.dictionary)))
+        dataset = LanguagePairDataset(
+            _ArrayTextDataset(ids, offsets, self.dictionary), None,
+            pad_id=self.dictionary.pad_id, eos_id=self.dictionary.eos_id)
+        if num_truncated[0] > 0:
+            logging.warning('{} input lines are longer than {} tokens and are truncated'.format(
+                num_truncated[0], self.max_positions))
+
+        indices = np.argsort(dataset.src.sizes, kind='mergesort')
+
+        result = []
+        for batch in _make_batches_fast(
+                dataset.src, None, indices, self.max_tokens, self.max_sentences,
+                (self.max_positions, self.max_positions), allow_different_src_lens=True):
+            sample = dataset.collate_indices(batch)
+            sample['id'] += start
+            result.append(sample)
+        return result
+
+
+class _LoaderError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _gather_tokens(dataset, indices, lengths, pad_id, eos_id, left_pad, move_eos_to_beginning=False):
+    """Gather and pad tokens of samples from the flat token buffer of the dataset.
+
+    Returns:
+        tuple: (tokens, shifted tokens or None), arrays of shape (batch_size, max_length)
+    """
+    batch_size, max_length = len(indices), int(lengths.max())
+    positions = np.arange(max_length)[None, :]
+    first = (max_length - lengths) if left_pad else np.zeros_like(lengths)
+    positions = positions - first[:, None]
+    mask = (positions >= 0) & (positions < lengths[:, None])
+    flat_positions = np.where(mask, np.asarray(dataset.offsets[indices])[:, None] + positions, 0)
+    tokens = np.where(mask, dataset.buffer[flat_positions], pad_id)
+
+    shifted = None
+    if move_eos_to_beginning:
+        shifted = np.full_like(tokens, pad_id)
+        shifted[:, 1:] = tokens[:, :-1]
+        shifted = np.where(mask, shifted, pad_id)
+        shifted[np.arange(batch_size), first] = eos_id
+    return tokens, shifted
+
+
+def _to_tensor(array_, buffers, slot, name):
+    if buffers is None:
+        return th.from_numpy(array_.astype(np.int64))
+    tensor = buffers.get(slot, name, array_.shape)
+    tensor.numpy()[...] = array_
+    return tensor
 
 
 def _valid_size(src_size, trg_size, max_positions):
@@ -458,13 +1387,337 @@ def _make_batches(src, trg, indices, max_tokens, max_sentences, max_positions,
               "and will be ignored, first few sample ids={}".format(len(ignored), ignored[:10]))
 
 
-def mask_batches(batch_sampler, shard_id, num_shards):
+def _valid_size_mask(src_sizes, trg_sizes, max_positions, min_length=1, max_ratio=None):
+    """Vectorized version of ``_valid_size``.
+
+    Also filter by min length and max length ratio (max(src / trg, trg / src)) of sizes if given.
+    """
+    if isinstance(max_positions, numbers.Number):
+        max_src_positions, max_trg_positions = max_positions, max_positions
+    else:
+        max_src_positions, max_trg_positions = max_positions
+    mask = (src_sizes >= min_length) & (src_sizes <= max_src_positions) & \
+        (trg_sizes >= min_length) & (trg_sizes <= max_trg_positions)
+    if max_ratio is not None:
+        src_sizes, trg_sizes = np.asarray(src_sizes, dtype=np.int64), np.asarray(trg_sizes, dtype=np.int64)
+        mask &= (src_sizes <= max_ratio * trg_sizes) & (trg_sizes <= max_ratio * src_sizes)
+    return mask
+
+
+def filter_file_path(dataset_dir, task, split):
+    return os.path.join(dataset_dir, '{}.{}.{}-{}.filter.npz'.format(
+        split, task.UniqueFilename, task.SourceLang, task.TargetLang))
+
+
+def _filter_key(max_positions, min_length=1, max_ratio=None):
+    if isinstance(max_positions, numbers.Number):
+        max_positions = (max_positions, max_positions)
+    return (int(max_positions[0]), int(max_positions[1])), int(min_length), \
+        (None if max_ratio is None else float(max_ratio))
+
+
+def save_filter(path, mask, max_positions, min_length=1, max_ratio=None):
+    """Save the mask of valid samples, with the filter parameters."""
+    (max_src_positions, max_trg_positions), min_length, max_ratio = _filter_key(max_positions, min_length, max_ratio)
+    tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+    np.savez(tmp_path, mask=np.packbits(mask), length=len(mask),
+             max_positions=np.array([max_src_positions, max_trg_positions]), min_length=min_length,
+             max_ratio=np.nan if max_ratio is None else max_ratio)
+    os.replace(tmp_path, path)
+
+
+def build_filter(path, src_sizes, trg_sizes, max_positions, min_length=1, max_ratio=None):
+    """Compute and save the mask of valid samples.
+
+    Returns:
+        The mask.
+    """
+    key = _filter_key(max_positions, min_length, max_ratio)
+    mask = _valid_size_mask(np.asarray(src_sizes), np.asarray(trg_sizes), *key)
+    save_filter(path, mask, *key)
+    return mask
+
+
+def load_filter(path, length, max_positions, min_length=1, max_ratio=None):
+    """Load the mask of valid samples if it was built with the same filter parameters, else return None."""
+    if path is None or not os.path.exists(path):
+        return None
+    key = _filter_key(max_positions, min_length, max_ratio)
+    with np.load(path) as data:
+        saved_max_ratio = float(data['max_ratio'])
+        saved_key = (tuple(data['max_positions'].tolist()), int(data['min_length']),
+                     None if np.isnan(saved_max_ratio) else saved_max_ratio)
+        if int(data['length']) != length or saved_key != key:
+            return None
+        return np.unpackbits(data['mask'], count=length).astype(bool)
+
+
+def _make_batches_fast(src, trg, indices, max_tokens, max_sentences, max_positions,
+                       ignore_invalid_inputs=False, allow_different_src_lens=False, required_batch_size_multiple=8):
+    """Vectorized version of ``_make_batches``, produce the same batches.
+
+    Invalid sizes are filtered with masks. For each batch, the running max lengths and token budgets of
+    the following samples are computed with cumulative operations, and the first sample that breaks the
+    limits is found at once. The batch is then cut by ``required_batch_size_multiple`` and the rest samples
+    are carried into the next batch, same as ``_make_batches``.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    src_sizes = src.sizes[indices]
+    trg_sizes = trg.sizes[indices] if trg else src_sizes
+
+    valid = _valid_size_mask(src_sizes, trg_sizes, max_positions)
+    ignored = None
+    if not valid.all():
+        if not ignore_invalid_inputs:
+            first = int(np.argmin(valid))
+            raise Exception((
+                "Sample #{} has size (src={}, trg={}) but max size is {}."
+                " Skip this example with --skip-invalid-size-inputs-valid-test"
+            ).format(indices[first], src_sizes[first], trg_sizes[first], max_positions))
+        ignored = indices[~valid]
+        indices, src_sizes, trg_sizes = indices[valid], src_sizes[valid], trg_sizes[valid]
+
+    sample_lens = np.maximum(src_sizes, trg_sizes)
+    num_samples = len(indices)
+
+    start = 0       # Start of the current batch.
+    checked = 1     # Samples before this (relative) position are already in the current batch.
+    window = 64
+    while start < num_samples:
+        if max_sentences != float('Inf'):
+            window = min(window, int(max_sentences) + 1)
+        end = min(num_samples, start + window)
+
+        positions = np.arange(end - start)
+        num_tokens = (positions + 1) * np.maximum.accumulate(sample_lens[start:end])
+        yield_mask = (positions >= max_sentences) | (num_tokens > max_tokens)
+        if not allow_different_src_lens:
+            yield_mask |= src_sizes[start:end] != src_sizes[start]
+        yield_mask[:checked] = False
+
+        hits = np.flatnonzero(yield_mask)
+        if len(hits) == 0:
+            if end == num_samples:
+                break
+            window *= 2
+            continue
+
+        batch_len = int(hits[0])
+        mod_len = max(
+            required_batch_size_multiple * (batch_len // required_batch_size_multiple),
+            batch_len % required_batch_size_multiple,
+        )
+        yield indices[start:start + mod_len].tolist()
+        start += mod_len
+        checked = batch_len - mod_len + 1
+        window = max(64, 2 * batch_len)
+
+    if start < num_samples:
+        yield indices[start:].tolist()
+
+    if ignored is not None:
+        print("Warning! {} samples are either too short or too long "
+              "and will be ignored, first few sample ids={}".format(len(ignored), ignored[:10].tolist()))
+
+
+def _make_bucket_batches(src, trg, indices, max_tokens, max_sentences, max_positions, num_buckets=16,
+                         boundaries=None):
+    """Make batches inside 2-D length buckets.
+
+    Source and target lengths are each split into ``num_buckets`` ranges at the quantiles of their histograms.
+    Samples are sorted by (source bucket, target bucket, source size, target size), and each bucket is batched
+    separately, so a batch never mixes very different source or target lengths.
+    Invalid sizes are ignored.
+
+    Args:
+        boundaries: (source boundaries, target boundaries) of buckets, default is computed from the sizes.
+
+    Returns:
+        list: Batches.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    src_sizes = np.asarray(src.sizes[indices], dtype=np.int64)
+    trg_sizes = np.asarray(trg.sizes[indices], dtype=np.int64) if trg else src_sizes
+
+    valid = _valid_size_mask(src_sizes, trg_sizes, max_positions)
+    if not valid.all():
+        ignored = indices[~valid]
+        print("Warning! {} samples are either too short or too long "
+              "and will be ignored, first few sample ids={}".format(len(ignored), ignored[:10].tolist()))
+        indices, src_sizes, trg_sizes = indices[valid], src_sizes[valid], trg_sizes[valid]
+    if len(indices) == 0:
+        return []
+
+    if boundaries is None:
+        quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+        boundaries = np.unique(np.quantile(src_sizes, quantiles)), np.unique(np.quantile(trg_sizes, quantiles))
+    src_buckets = np.searchsorted(boundaries[0], src_sizes, side='right')
+    trg_buckets = np.searchsorted(boundaries[1], trg_sizes, side='right')
+
+    order = np.lexsort((trg_sizes, src_sizes, trg_buckets, src_buckets))
+    indices = indices[order]
+    bucket_ids = (src_buckets * num_buckets + trg_buckets)[order]
+    bounds = np.flatnonzero(np.diff(bucket_ids)) + 1
+
+    batches = []
+    for bucket in np.split(indices, bounds):
+        batches.extend(_make_batches_fast(
+            src, trg, bucket, max_tokens, max_sentences, max_positions,
+            ignore_invalid_inputs=True, allow_different_src_lens=True))
+    return batches
+
+
+def _padding_ratio(batches, sizes):
+    """Get padded tokens / real tokens of the batches."""
+    batches = [b for b in batches if len(b) > 0]
+    if not batches:
+        return 0.0
+    batch_sizes = np.array([len(b) for b in batches], dtype=np.int64)
+    lengths = np.asarray(sizes[np.concatenate([np.asarray(b, dtype=np.int64) for b in batches])], dtype=np.int64)
+    starts = np.zeros(len(batches), dtype=np.int64)
+    np.cumsum(batch_sizes[:-1], out=starts[1:])
+    real = lengths.sum()
+    padded = (np.maximum.reduceat(lengths, starts) * batch_sizes).sum() - real
+    return padded / max(real, 1)
+
+
+def _load_batches(path):
+    """Load the persisted batch plan, return None if not exists."""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            indices, offsets = data['indices'], data['offsets']
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning('Failed to load batch plan from {!r}: {}'.format(path, e))
+        return None
+    logging.info('Load batch plan from {!r}'.format(path))
+    return [indices[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
+
+def _save_batches(path, batches):
+    """Persist the batch plan as flat indices + batch offsets."""
+    if path is None:
+        return
+    sizes = np.array([len(b) for b in batches], dtype=np.int64)
+    offsets = np.zeros(len(batches) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    indices = np.fromiter((i for b in batches for i in b), dtype=np.int64, count=int(offsets[-1]))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, indices=indices, offsets=offsets)
+        # [NOTE]: Atomic rename, other processes never see partial files.
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning('Failed to save batch plan to {!r}: {}'.format(path, e))
+
+
+def mask_batches(batch_sampler, shard_id, num_shards, strategy='round_robin', sizes=None, seed=None, shuffle=True):
+    """Get the batches of a distributed rank.
+
+    Args:
+        batch_sampler: List of batches.
+        shard_id: Current rank.
+        num_shards: Number of ranks.
+        strategy: How to assign batches to ranks.
+            'round_robin': Batch ``i`` is assigned to rank ``i % num_shards``.
+            'balanced': Batches with similar padded token counts are grouped into steps, one batch for each
+                rank, and assigned greedily to the least loaded rank, so ranks do similar work in each step.
+        sizes: (source sizes, target sizes), required by the 'balanced' strategy.
+        seed: Seed to shuffle the steps of the 'balanced' strategy.
+        shuffle: Shuffle the steps of the 'balanced' strategy, else keep the batch order roughly.
+
+    Returns:
+        List of batches of the rank, short ranks are padded with empty batches.
+    """
     if num_shards == 1:
         return batch_sampler
-    res = [
-        batch
-        for i, batch in enumerate(batch_sampler)
-        if i % num_shards == shard_id
-    ]
-    expected_length = int(math.ceil(len(batch_sampler) / num_shards))
-    return res + [[]] * (expected_length - len(res))
+    if strategy == 'round_robin':
+        res = [
+            batch
+            for i, batch in enumerate(batch_sampler)
+            if i % num_shards == shard_id
+        ]
+        expected_length = int(math.ceil(len(batch_sampler) / num_shards))
+        res = res + [[]] * (expected_length - len(res))
+        # [NOTE]: Costs are only used by the log of rank 0, do not compute them on other ranks.
+        if sizes is not None and shard_id == 0:
+            _log_shard_imbalance(batch_sampler, [
+                np.arange(r, r + num_shards * expected_length, num_shards) for r in range(num_shards)
+            ], _batch_costs(batch_sampler, *sizes), shard_id)
+        return res
+    elif strategy == 'balanced':
+        if sizes is None:
+            raise ValueError('Sizes are required by the balanced strategy')
+        costs = _batch_costs(batch_sampler, *sizes)
+        assignment = _balanced_assignment(costs, num_shards, seed=seed, shuffle=shuffle)
+        _log_shard_imbalance(batch_sampler, assignment, costs, shard_id)
+        return [batch_sampler[i] if i < len(batch_sampler) else [] for i in assignment[shard_id]]
+    else:
+        raise ValueError('Unknown shard strategy {!r}'.format(strategy))
+
+
+def _batch_costs(batches, src_sizes, trg_sizes=None):
+    """Get padded token counts of batches: batch size * max(max source length, max target length)."""
+    batch_sizes = np.array([len(b) for b in batches], dtype=np.int64)
+    costs = np.zeros(len(batches), dtype=np.int64)
+    non_empty = batch_sizes > 0
+    if not non_empty.any():
+        return costs
+    indices = np.concatenate([np.asarray(b, dtype=np.int64) for b in batches if len(b) > 0])
+    lengths = np.asarray(src_sizes[indices], dtype=np.int64)
+    if trg_sizes is not None:
+        lengths = np.maximum(lengths, np.asarray(trg_sizes[indices], dtype=np.int64))
+    starts = np.zeros(non_empty.sum(), dtype=np.int64)
+    np.cumsum(batch_sizes[non_empty][:-1], out=starts[1:])
+    costs[non_empty] = np.maximum.reduceat(lengths, starts) * batch_sizes[non_empty]
+    return costs
+
+
+def _balanced_assignment(costs, num_shards, seed=None, shuffle=True):
+    """Assign batches to ranks by cost.
+
+    Returns:
+        Array of shape (num_shards, num_steps), batch indices of each rank.
+        Indices ``>= len(costs)`` mean empty batches.
+    """
+    num_batches = len(costs)
+    num_steps = int(math.ceil(num_batches / num_shards))
+
+    # Group batches with similar costs into steps.
+    # [NOTE]: Padding batches (cost 0) are put into the last step.
+    order = np.argsort(-costs, kind='mergesort')
+    order = np.concatenate([order, np.arange(num_batches, num_steps * num_shards)])
+    steps = order.reshape(num_steps, num_shards)
+
+    # Give the most expensive batch of each step to the least loaded rank.
+    padded_costs = np.concatenate([costs, np.zeros(num_steps * num_shards - num_batches, dtype=costs.dtype)])
+    loads = np.zeros(num_shards, dtype=np.int64)
+    assignment = np.empty((num_shards, num_steps), dtype=np.int64)
+    for step, batches in enumerate(steps):
+        ranks = np.argsort(loads, kind='mergesort')
+        assignment[ranks, step] = batches
+        loads[ranks] += padded_costs[batches]
+
+    if shuffle:
+        with numpy_seed(seed):
+            step_order = np.random.permutation(num_steps)
+    else:
+        step_order = np.argsort(steps.min(axis=1), kind='mergesort')
+    return assignment[:, step_order]
+
+
+def _log_shard_imbalance(batches, assignment, costs, shard_id):
+    """Log the per-rank imbalance of padded tokens."""
+    if shard_id != 0 or len(batches) == 0:
+        return
+    padded_costs = np.concatenate([costs, np.zeros(1, dtype=costs.dtype)])
+    step_costs = padded_costs[np.minimum(np.stack(assignment), len(costs))]
+    rank_totals = step_costs.sum(axis=1)
+    # Each synchronous step waits for the slowest rank.
+    sync_total = step_costs.max(axis=0).sum() * len(rank_totals)
+    logging.info('Shard imbalance: rank tokens min/max = {}/{}, step waiting = {:.2%}'.format(
+        rank_totals.min(), rank_totals.max(), 1 - rank_totals.sum() / max(sync_total, 1)))
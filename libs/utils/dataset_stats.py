@@ -0,0 +1,254 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Dataset statistics, computed once and stored beside the data.
+
+Stats file: ``stats.<unique-name>.<src-lang>-<trg-lang>.json`` in the dataset directory.
+
+Content (for each split):
+    num_sentences:      Number of sentence pairs.
+    files:              {filename: [size, mtime]} of the text files, to detect stale statistics.
+    src / trg:
+        num_tokens:     Number of words (EOS excluded).
+        num_unk:        Number of unknown words.
+        coverage:       Fraction of words in the dictionary.
+        mean, std, max: Of sentence lengths.
+        percentiles:    {'50': ..., '90': ..., '95': ..., '99': ...} of sentence lengths.
+        histogram:      Number of sentences of each length.
+    ratio:
+        mean, std:      Of target length / source length.
+        percentiles:    Same as above, in bins of ``RatioBinWidth``.
+        fit:            [a, b, residual std], least squares fit of ``trg_length = a * src_length + b``.
+
+All lengths are numbers of words, without EOS.
+"""
+
+from itertools import islice
+import json
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from .dictionary import Dictionary
+
+__author__ = 'fyabc'
+
+Percentiles = (50, 90, 95, 99)
+RatioBinWidth = 0.01
+MaxRatio = 10.0
+
+_worker_dicts = None
+
+
+def stats_file_path(dataset_dir, task):
+    return os.path.join(dataset_dir, 'stats.{}.{}-{}.json'.format(
+        task.UniqueFilename, task.SourceLang, task.TargetLang))
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def _init_worker(src_dict, trg_dict):
+    global _worker_dicts
+    _worker_dicts = src_dict, trg_dict
+
+
+def _chunk_stats(chunk):
+    """Get (source lengths, target lengths, source unknown words, target unknown words) of a chunk of lines."""
+    src_lines, trg_lines = chunk
+    result = []
+    for dictionary, lines in zip(_worker_dicts, (src_lines, trg_lines)):
+        ids, offsets = dictionary.encode_lines(lines, append_eos=False)
+        result.append((np.diff(offsets), int(np.count_nonzero(ids == dictionary.unk_id))))
+    (src_lengths, src_unk), (trg_lengths, trg_unk) = result
+    return src_lengths, trg_lengths, src_unk, trg_unk
+
+
+def _iter_chunks(src_file, trg_file, chunk_size):
+    while True:
+        src_lines = list(islice(src_file, chunk_size))
+        trg_lines = list(islice(trg_file, chunk_size))
+        if len(src_lines) != len(trg_lines):
+            raise ValueError('Source and target files have different number of lines')
+        if not src_lines:
+            return
+        yield src_lines, trg_lines
+
+
+class _Accumulator:
+    """Accumulate histograms and moments of a split chunk by chunk."""
+
+    def __init__(self):
+        self.histograms = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+        self.unk = [0, 0]
+        self.ratio_histogram = np.zeros(int(MaxRatio / RatioBinWidth) + 1, dtype=np.int64)
+        # n, sum x, sum y, sum xx, sum xy, sum yy, sum r, sum rr
+        self.moments = np.zeros(8, dtype=np.float64)
+
+    def add(self, src_lengths, trg_lengths, src_unk, trg_unk):
+        for i, (lengths, unk) in enumerate(((src_lengths, src_unk), (trg_lengths, trg_unk))):
+            histogram = np.bincount(lengths)
+            if len(histogram) > len(self.histograms[i]):
+                self.histograms[i] = np.pad(self.histograms[i], (0, len(histogram) - len(self.histograms[i])))
+            self.histograms[i][:len(histogram)] += histogram
+            self.unk[i] += unk
+
+        x, y = src_lengths.astype(np.float64), trg_lengths.astype(np.float64)
+        ratio = y / np.maximum(x, 1)
+        self.ratio_histogram += np.bincount(
+            np.minimum(ratio / RatioBinWidth, len(self.ratio_histogram) - 1).astype(np.int64),
+            minlength=len(self.ratio_histogram))
+        self.moments += [len(x), x.sum(), y.sum(), (x * x).sum(), (x * y).sum(), (y * y).sum(),
+                         ratio.sum(), (ratio * ratio).sum()]
+
+    def result(self):
+        n, sx, sy, sxx, sxy, syy, sr, srr = self.moments
+        n_ = max(n, 1)
+        result = {'num_sentences': int(n)}
+        for key, histogram, unk in zip(('src', 'trg'), self.histograms, self.unk):
+            lengths = np.arange(len(histogram))
+            num_tokens = int((lengths * histogram).sum())
+            mean = num_tokens / n_
+            result[key] = {
+                'num_tokens': num_tokens,
+                'num_unk': unk,
+                'coverage': 1 - unk / max(num_tokens, 1),
+                'mean': mean,
+                'std': float(np.sqrt(max((lengths ** 2 * histogram).sum() / n_ - mean ** 2, 0))),
+                'max': int(np.flatnonzero(histogram)[-1]) if histogram.any() else 0,
+                'percentiles': _histogram_percentiles(histogram),
+                'histogram': histogram.tolist(),
+            }
+
+        # Least squares fit of target lengths.
+        var_x = sxx / n_ - (sx / n_) ** 2
+        a = ((sxy / n_ - sx * sy / n_ ** 2) / var_x) if var_x > 0 else 1.0
+        b = (sy - a * sx) / n_
+        residual_var = (syy - 2 * a * sxy - 2 * b * sy + a * a * sxx + 2 * a * b * sx + b * b * n) / n_
+        ratio_mean = sr / n_
+        result['ratio'] = {
+            'mean': ratio_mean,
+            'std': float(np.sqrt(max(srr / n_ - ratio_mean ** 2, 0))),
+            'percentiles': {
+                k: v * RatioBinWidth for k, v in _histogram_percentiles(self.ratio_histogram).items()},
+            'fit': [a, b, float(np.sqrt(max(residual_var, 0)))],
+        }
+        return result
+
+
+def _histogram_percentiles(histogram):
+    cdf = np.cumsum(histogram)
+    if len(cdf) == 0 or cdf[-1] == 0:
+        return {str(p): 0 for p in Percentiles}
+    return {str(p): int(np.searchsorted(cdf, p / 100 * cdf[-1])) for p in Percentiles}
+
+
+def compute_split_stats(src_path, trg_path, src_dict, trg_dict, pool, chunk_size=10000):
+    """Compute statistics of a split, stream the files in chunks and process them in the pool."""
+    accumulator = _Accumulator()
+    with open(src_path, 'r', encoding='utf-8') as src_file, open(trg_path, 'r', encoding='utf-8') as trg_file:
+        for chunk_result in pool.imap(_chunk_stats, _iter_chunks(src_file, trg_file, chunk_size)):
+            accumulator.add(*chunk_result)
+    result = accumulator.result()
+    result['files'] = {
+        os.path.basename(src_path): _file_signature(src_path),
+        os.path.basename(trg_path): _file_signature(trg_path),
+    }
+    return result
+
+
+def compute_stats(task, dataset_dir, splits=('train', 'dev', 'test'), workers=None, chunk_size=10000):
+    """Compute statistics of the dataset splits.
+
+    Returns:
+        dict: Split name -> statistics.
+    """
+    src_dict, trg_dict = [
+        Dictionary(os.path.join(dataset_dir, task.get_filename('dict', is_src_lang=is_src)),
+                   task, is_src_lang=is_src, mode=task.SourceDictType if is_src else task.TargetDictType)
+        for is_src in (True, False)
+    ]
+    stats = {}
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(src_dict, trg_dict)) as pool:
+        for split in splits:
+            stats[split] = compute_split_stats(
+                os.path.join(dataset_dir, task.get_filename(split, is_src_lang=True)),
+                os.path.join(dataset_dir, task.get_filename(split, is_src_lang=False)),
+                src_dict, trg_dict, pool, chunk_size=chunk_size)
+    return stats
+
+
+def save_stats(path, stats):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, path)
+
+
+def load_stats(path):
+    """Load the statistics, skip splits whose text files are changed.
+
+    Returns:
+        dict: Split name -> statistics, or None if not available.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    dataset_dir = os.path.dirname(path)
+    for split in list(stats):
+        for filename, signature in stats[split]['files'].items():
+            full_path = os.path.join(dataset_dir, filename)
+            if os.path.exists(full_path) and _file_signature(full_path) != signature:
+                logging.warning('Statistics of split {!r} are stale, ignore them'.format(split))
+                del stats[split]
+                break
+    return stats
+
+
+def maxlen_a_b(stats, split='train', num_std=2.0):
+    """Get the factors a & b of target length in generation from the statistics.
+
+    trg_length = a * src_length + b, where b is raised by ``num_std`` standard deviations of the fit residual.
+
+    Returns:
+        (a, b), or None if the split is not available.
+    """
+    if stats is None or split not in stats:
+        return None
+    a, b, residual_std = stats[split]['ratio']['fit']
+    return a, b + num_std * residual_std
+
+
+def bucket_boundaries(stats, split, num_buckets):
+    """Get length bucket boundaries of source and target at the quantiles of the length histograms.
+
+    Boundaries are in sizes (EOS included), same as ``np.quantile`` of dataset sizes.
+
+    Returns:
+        (source boundaries, target boundaries), or None if the split is not available.
+    """
+    if stats is None or split not in stats:
+        return None
+    quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+    result = []
+    for key in ('src', 'trg'):
+        cdf = np.cumsum(stats[split][key]['histogram'])
+        boundaries = np.searchsorted(cdf, quantiles * cdf[-1]) + 1
+        result.append(np.unique(boundaries))
+    return tuple(result)
+
+
+__all__ = [
+    'stats_file_path',
+    'compute_split_stats',
+    'compute_stats',
+    'save_stats',
+    'load_stats',
+    'maxlen_a_b',
+    'bucket_boundaries',
+]
@@ -3,12 +3,15 @@
 
 """Dictionary: a simple wrapper of dict."""
 
+import itertools
 import logging
 import pickle
 
+import numpy as np
 import torch as th
 
 from ..tasks import get_task
+from .tokenizer import tokenize_line
 
 __author__ = 'fyabc'
 
@@ -33,6 +36,7 @@ class Dictionary:
             raise ValueError('Unknown dictionary initialization mode {!r}'.format(mode))
 
         self._idict = {v: k for k, v in self._dict.items()}
+        self._symbols = None
 
         self.is_src_lang = is_src_lang
 
@@ -118,6 +122,7 @@ class Dictionary:
     def _add(self, symbol, s_id):
         self._dict[symbol] = s_id
         self._idict[s_id] = symbol
+        self._symbols = None
 
     def get(self, symbol, add_if_not_exist=False):
         if add_if_not_exist:
@@ -128,32 +133,105 @@ class Dictionary:
             return s_id
         return self._dict.get(symbol, self.task.UNK_ID)
 
+    def symbols(self):
+        """Get the NumPy object array of symbols, indexed by token id."""
+        if self._symbols is None:
+            symbols = np.empty(max(self._idict) + 1, dtype=object)
+            for s_id, symbol in self._idict.items():
+                symbols[s_id] = symbol
+            self._symbols = symbols
+        return self._symbols
+
     def string(self, tensor, bpe_symbol=None, escape_unk=False, remove_pad=True):
         """Helper for converting a tensor of token indices to a string.
 
         Can optionally remove BPE symbols or escape <unk> words.
         """
         if th.is_tensor(tensor) and tensor.dim() == 2:
-            return '\n'.join(self.string(t) for t in tensor)
-
-        def yield_string(t):
-            for elem in t:
-                i = int(elem)   # Compatibility for PyTorch 0.3.1 and 0.4.0 (scalar tensor)
-                if i == self.unk_id:
-                    yield self.unk_string(escape_unk)
-                elif i == self.pad_id:
-                    if not remove_pad:
-                        yield self._idict[i]
-                elif i == self.eos_id:
-                    # TODO: `continue` in fairseq-py, but should it be `return`?
-                    return
-                else:
-                    yield self._idict[i]
-
-        sent = ' '.join(yield_string(tensor))
+            # [NOTE]: Same as the original per-row ``self.string(t)``, options only apply to 1-D tensors.
+            return '\n'.join(self.decode_batch(tensor))
+        return self.decode_batch([tensor], bpe_symbol, escape_unk, remove_pad)[0]
+
+    def decode_batch(self, tokens, bpe_symbol=None, escape_unk=False, remove_pad=True):
+        """Convert a batch of token indices to strings.
+
+        Each sentence is truncated at the first EOS, and PAD tokens are removed.
+        Symbols are looked up for the whole batch at once, only the join is done per sentence.
+
+        Args:
+            tokens: 2-D tensor or array of token indices, or list of 1-D tensors.
+            bpe_symbol: BPE symbol to remove.
+            escape_unk: Escape <unk> words as <<unk>>.
+            remove_pad: Remove PAD tokens.
+
+        Returns:
+            list: Strings of sentences.
+        """
+        ids = self._id_matrix(tokens)
+        batch_size, length = ids.shape
+
+        # [NOTE]: `continue` in fairseq-py, but stop at the first EOS here.
+        is_eos = ids == self.eos_id
+        ends = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), length)
+        keep = np.arange(length)[None, :] < ends[:, None]
+        if remove_pad:
+            keep &= ids != self.pad_id
+
+        words = self.symbols()[ids]
+        words[ids == self.unk_id] = self.unk_string(escape_unk)
+
+        sents = [' '.join(row[row_keep]) for row, row_keep in zip(words, keep)]
         if bpe_symbol is not None:
-            sent = sent.replace(bpe_symbol, '')
-        return sent
+            sents = [sent.replace(bpe_symbol, '') for sent in sents]
+        return sents
+
+    def _id_matrix(self, tokens):
+        """Convert tokens into a 2-D int64 array, rows of different lengths are padded with EOS."""
+        if th.is_tensor(tokens):
+            return tokens.cpu().numpy().astype(np.int64, copy=False).reshape(tokens.size(0), -1)
+        if isinstance(tokens, np.ndarray) and tokens.ndim == 2:
+            return tokens.astype(np.int64, copy=False)
+        rows = [t.cpu().numpy() if th.is_tensor(t) else np.asarray(t) for t in tokens]
+        ids = np.full((len(rows), max((len(r) for r in rows), default=0)), self.eos_id, dtype=np.int64)
+        for i, row in enumerate(rows):
+            ids[i, :len(row)] = row
+        return ids
+
+    def encode_lines(self, lines, line_tokenizer=tokenize_line, add_if_not_exist=False,
+                     append_eos=True, reverse_order=False):
+        """Convert lines to token indices, same as calling ``Tokenizer.tokenize`` on each line.
+
+        Args:
+            lines: Iterable of lines.
+            line_tokenizer: Function to split a line into words.
+            add_if_not_exist: Add unknown words into the dictionary.
+            append_eos: Append EOS to each line.
+            reverse_order: Reverse the words of each line.
+
+        Returns:
+            tuple: (ids, offsets), int64 arrays. Token indices of line ``i`` are ``ids[offsets[i]:offsets[i + 1]]``.
+        """
+        words_list = [line_tokenizer(line) for line in lines]
+        if reverse_order:
+            words_list = [words[::-1] for words in words_list]
+
+        offsets = np.zeros(len(words_list) + 1, dtype=np.int64)
+        np.cumsum([len(words) + int(append_eos) for words in words_list], out=offsets[1:])
+
+        words = itertools.chain.from_iterable(words_list)
+        if add_if_not_exist:
+            word_ids = [self.get(word, add_if_not_exist=True) for word in words]
+        else:
+            word_ids = list(map(self._dict.get, words, itertools.repeat(self.unk_id)))
+        word_ids = np.array(word_ids, dtype=np.int64)
+
+        if not append_eos:
+            return word_ids, offsets
+        ids = np.full(offsets[-1], self.eos_id, dtype=np.int64)
+        is_word = np.ones(offsets[-1], dtype=bool)
+        is_word[offsets[1:] - 1] = False
+        ids[is_word] = word_ids
+        return ids, offsets
 
     def unk_string(self, escape=False):
         """Return unknown string, optionally escaped as: <<unk>>"""
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import math
+import numbers
 import pickle
+import time
+from itertools import chain
 
 import torch
 import torch.distributed as dist
@@ -16,6 +19,11 @@ def is_master(hparams):
     return hparams.distributed_rank == 0
 
 
+def is_multiprocess():
+    """Test if training processes are synchronized with ``torch.distributed`` (instead of ``DataParallel``)."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
 def distributed_init(hparams):
     if hparams.distributed_world_size == 1:
         raise ValueError('Cannot initialize distributed with distributed_world_size=1')
@@ -104,14 +112,222 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom, buffer_size=10485760)
         all_reduce_buffer()
 
 
+class BucketedAllReducer:
+    """All-reduce gradients in buckets asynchronously, overlapped with the backward pass.
+
+    Parameters are grouped into buckets of about ``bucket_size`` bytes in reverse order, since gradients of the
+    last layers are ready first. A hook on each parameter marks its gradient ready after it is accumulated, and
+    when all gradients of a bucket are ready, the bucket is all-reduced asynchronously while backward goes on.
+    Buckets are always launched in order (a ready bucket waits for the previous ones), so all processes issue the
+    same sequence of collectives. ``wait`` launches the rest buckets (e.g. of unused parameters), and waits on all
+    of them.
+
+    If the gradients are views of a flat buffer (``flat_grads``, see ``ChildTrainer._flatten_params``), buckets
+    are all-reduced in place on slices of the buffer, else gradients are copied into and out of bucket buffers.
+
+    Gradients are only all-reduced (summed, not averaged) in the backward passes after ``prepare(True)``.
+    """
+
+    def __init__(self, params, bucket_size=10485760, flat_grads=None):
+        self.params = [p for p in params if p.requires_grad]
+        self.flat_grads = flat_grads
+        self.active = False
+
+        # Group parameters into buckets in reverse order.
+        self.buckets = []
+        bucket, filled = [], 0
+        for p in reversed(self.params):
+            size = p.numel() * p.element_size()
+            if bucket and filled + size > bucket_size:
+                self.buckets.append(bucket)
+                bucket, filled = [], 0
+            bucket.append(p)
+            filled += size
+        if bucket:
+            self.buckets.append(bucket)
+
+        self._bucket_of = {}
+        for i, bucket in enumerate(self.buckets):
+            for p in bucket:
+                self._bucket_of[p] = i
+        self._slices = self._flat_slices() if flat_grads is not None else None
+        self._buffers = [None for _ in self.buckets]
+        self._num_ready = [0 for _ in self.buckets]
+        self._handles = [None for _ in self.buckets]
+        self._next_bucket = 0
+
+        # Statistics of the last step, see ``overlap``.
+        self.overlapped_bytes = 0
+        self.total_bytes = sum(p.numel() * p.element_size() for p in self.params)
+        self.wait_time = 0.0
+
+        self._grad_accs = []
+        self._hook_handles = [self._register_hook(p) for p in self.params]
+
+    def _flat_slices(self):
+        """Get the slice of the flat buffer of each bucket, parameters of a bucket must be adjacent in the buffer."""
+        base = self.flat_grads.data_ptr()
+        slices = []
+        for bucket in self.buckets:
+            offsets = [(p.grad.data_ptr() - base) // p.grad.element_size() for p in bucket]
+            start, end = min(offsets), max(o + p.numel() for o, p in zip(offsets, bucket))
+            if end - start != sum(p.numel() for p in bucket):
+                raise ValueError('Gradients of a bucket are not adjacent in the flat buffer')
+            slices.append((start, end))
+        return slices
+
+    def _register_hook(self, p):
+        if hasattr(p, 'register_post_accumulate_grad_hook'):
+            return p.register_post_accumulate_grad_hook(lambda param: self._on_grad_ready(param))
+        # [NOTE]: Old PyTorch, hook the gradient accumulator of the parameter.
+        grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+        self._grad_accs.append(grad_acc)
+        return grad_acc.register_hook(lambda *_: self._on_grad_ready(p))
+
+    def prepare(self, active=True):
+        """Call before backward, all-reduce gradients in this backward pass or not."""
+        self.active = active
+        self._num_ready = [0 for _ in self.buckets]
+        self._handles = [None for _ in self.buckets]
+        self._next_bucket = 0
+        self.overlapped_bytes = 0
+        self.wait_time = 0.0
+
+    def _on_grad_ready(self, p):
+        if not self.active:
+            return
+        self._num_ready[self._bucket_of[p]] += 1
+        while self._next_bucket < len(self.buckets) and \
+                self._num_ready[self._next_bucket] == len(self.buckets[self._next_bucket]):
+            self._launch(self._next_bucket)
+            self.overlapped_bytes += sum(q.numel() * q.element_size() for q in self.buckets[self._next_bucket])
+            self._next_bucket += 1
+
+    def _launch(self, i):
+        if self._slices is not None:
+            start, end = self._slices[i]
+            buffer = self.flat_grads[start:end]
+        else:
+            grads = [p.grad.data.view(-1) if p.grad is not None else p.data.new_zeros(p.numel())
+                     for p in self.buckets[i]]
+            buffer = self._buffers[i]
+            if buffer is None:
+                buffer = self._buffers[i] = grads[0].new_empty(sum(g.numel() for g in grads))
+            torch.cat(grads, out=buffer)
+        self._handles[i] = dist.all_reduce(buffer, async_op=True)
+
+    def wait(self):
+        """Wait on all all-reduces of the backward pass, and copy the results back into gradients."""
+        if not self.active:
+            return
+        start_time = time.time()
+        for i in range(self._next_bucket, len(self.buckets)):
+            self._launch(i)
+        for i, handle in enumerate(self._handles):
+            handle.wait()
+            if self._slices is None:
+                offset = 0
+                for p in self.buckets[i]:
+                    numel = p.numel()
+                    if p.grad is None:
+                        p.grad = p.data.new_zeros(p.size())
+                    p.grad.data.view(-1).copy_(self._buffers[i][offset:offset + numel])
+                    offset += numel
+        self.wait_time = time.time() - start_time
+        self.active = False
+
+    def discard(self):
+        """Discard the local gradients of a failed backward pass (e.g. out of memory), then wait like ``wait``.
+
+        All-reduces already launched can not be undone, so their results are kept. Gradients of the other buckets
+        are zeroed before they are launched, so this process contributes zeros to them, and all processes still
+        get the same reduced gradients.
+        """
+        if not self.active:
+            return
+        for bucket in self.buckets[self._next_bucket:]:
+            for p in bucket:
+                if p.grad is not None:
+                    p.grad.data.zero_()
+        self.wait()
+
+    def overlap(self):
+        """Fraction of gradient bytes whose all-reduce was launched during the last backward pass."""
+        return self.overlapped_bytes / self.total_bytes if self.total_bytes > 0 else 0.0
+
+    def remove(self):
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+
+# Keys of logging outputs that are summed with a tensor by ``all_reduce_logging_outputs``.
+LoggingOutputKeys = ('loss', 'nll_loss', 'ntokens', 'nsentences', 'sample_size')
+
+
+def _to_number(value):
+    return int(value) if value.is_integer() else value
+
+
+def all_reduce_logging_outputs(logging_outputs, stats, keys=LoggingOutputKeys):
+    """Sum logging outputs and numeric stats (e.g. sample sizes, OOMs) over all processes.
+
+    Values are packed into a fixed-schema tensor and summed by one small all-reduce, instead of pickled and
+    gathered by ``all_gather_list``. Since criterions aggregate logging outputs by summing their values, the
+    summed logging output is aggregated to the same result.
+
+    If logging outputs of any process contain other keys (or non-number values), fall back to gather them all
+    with ``all_gather_list``.
+
+    Args:
+        logging_outputs: List of logging outputs (dicts) of this process.
+        stats: List of numbers of this process, e.g. [sample size, number of OOMs].
+        keys: Keys of the fixed schema.
+
+    Returns:
+        tuple: (list of logging outputs, list of summed stats).
+            The list of logging outputs contains one summed logging output, or all gathered logging outputs.
+    """
+    num_keys = len(keys)
+    key_index = {k: i for i, k in enumerate(keys)}
+
+    # [NOTE]: Schema: [sum of values of each key, number of values of each key, stats, number of unknown values].
+    values = [0.0] * (2 * num_keys + len(stats) + 1)
+    for log in logging_outputs:
+        for k, v in log.items():
+            if k in key_index and isinstance(v, numbers.Number):
+                values[key_index[k]] += v
+                values[num_keys + key_index[k]] += 1
+            else:
+                values[-1] += 1
+    values[2 * num_keys:-1] = stats
+
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    buffer = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(buffer)
+    values = buffer.tolist()
+
+    summed_stats = [_to_number(v) for v in values[2 * num_keys:-1]]
+    if values[-1] > 0:
+        return list(chain.from_iterable(all_gather_list(logging_outputs))), summed_stats
+    summed_log = {
+        k: _to_number(values[i])
+        for i, k in enumerate(keys)
+        if values[num_keys + i] > 0
+    }
+    return [summed_log], summed_stats
+
+
 def all_gather_list(data, max_size=4096):
     """Gathers arbitrary data from all nodes into a list."""
     world_size = torch.distributed.get_world_size()
+    # [NOTE]: NCCL only supports CUDA tensors, gloo (CPU training) uses CPU tensors.
+    device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu'
     if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != all_gather_list._in_buffer.size():
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
+            max_size != all_gather_list._in_buffer.numel() or device != all_gather_list._in_buffer.device.type:
+        all_gather_list._in_buffer = torch.zeros(max_size, dtype=torch.uint8, device=device)
         all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
+            torch.zeros(max_size, dtype=torch.uint8, device=device)
             for i in range(world_size)
         ]
     in_buffer = all_gather_list._in_buffer
@@ -126,7 +342,7 @@ def all_gather_list(data, max_size=4096):
     in_buffer[1] = enc_size % 255
     in_buffer[2:enc_size+2] = torch.ByteTensor(list(enc))
 
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
+    torch.distributed.all_gather(out_buffers, in_buffer)
 
     result = []
     for i in range(world_size):
@@ -4,11 +4,12 @@
 import collections
 import logging
 import math
+import os
+import time
 
+import numpy as np
 import torch
 
-from . import tokenizer
-
 __author__ = 'fyabc'
 
 
@@ -190,12 +191,13 @@ def batch_bleu(generator, id_list, translation, ref_tokens, ref_dict):
     task = generator.task
     datasets = generator.datasets
 
-    trans_str = (datasets.target_dict.string(t, bpe_symbol=task.BPESymbol, escape_unk=True) for t in translation)
-    # trans_str = list(trans_str)
+    trans_str = datasets.target_dict.decode_batch(translation, bpe_symbol=task.BPESymbol, escape_unk=True)
     # print('$', *trans_str, sep='\n')
 
     # [NOTE]: Translation and references must be tokenized with same dictionary.
-    trans_corpus = [tokenizer.Tokenizer.tokenize(t, ref_dict, tensor_type=torch.IntTensor) for t in trans_str]
+    trans_ids, trans_offsets = ref_dict.encode_lines(trans_str, add_if_not_exist=True)
+    trans_ids = torch.from_numpy(trans_ids.astype(np.int32))
+    trans_corpus = [trans_ids[start:end] for start, end in zip(trans_offsets[:-1], trans_offsets[1:])]
 
     ref_corpus = [[ref_tokens[i]] for i in id_list]
     # print('#', *[ref_dict.string(t[0], bpe_symbol=task.BPESymbol, escape_unk=True) for t in ref_corpus], sep='\n')
@@ -204,3 +206,96 @@ def batch_bleu(generator, id_list, translation, ref_tokens, ref_dict):
 
     # print('%', result)
     return result
+
+
+class OrderedOutputWriter:
+    """Write outputs of samples into a file in the order of sample ids, as soon as all previous ids are done.
+
+    Outputs of later ids wait in a reorder buffer until the outputs before them are written, so only the
+    out-of-order part is kept in memory. The file is flushed and fsync-ed every ``fsync_interval`` seconds
+    and at closing, so a crash only loses the last outputs.
+
+    Args:
+        path: Output filename.
+        resume: Keep the lines already in the file (an incomplete last line is removed), and continue from them.
+            Ids before ``num_written`` are already done and their outputs are ignored.
+        fsync_interval: Seconds between fsync calls, 0 means fsync after every write.
+    """
+
+    def __init__(self, path, resume=False, fsync_interval=30.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.next_id = 0
+        self.pending = {}
+
+        if resume and os.path.exists(path):
+            self.f = open(path, 'r+b')
+            self.next_id = self._truncate_incomplete_line()
+            logging.info('Resume output {!r} from {} lines'.format(path, self.next_id))
+        else:
+            self.f = open(path, 'wb')
+        self._last_sync = time.time()
+
+    def _truncate_incomplete_line(self):
+        """Truncate the file after the last newline, return the number of lines."""
+        num_lines, end = 0, 0
+        offset = 0
+        while True:
+            chunk = self.f.read(1 << 20)
+            if not chunk:
+                break
+            num_lines += chunk.count(b'\n')
+            last = chunk.rfind(b'\n')
+            if last >= 0:
+                end = offset + last + 1
+            offset += len(chunk)
+        self.f.truncate(end)
+        self.f.seek(end)
+        return num_lines
+
+    @property
+    def num_written(self):
+        return self.next_id
+
+    def done(self, id_):
+        return id_ < self.next_id or id_ in self.pending
+
+    def write(self, id_, line):
+        if self.done(id_):
+            return
+        self.pending[id_] = line
+        if id_ != self.next_id:
+            return
+        lines = []
+        while self.next_id in self.pending:
+            lines.append(self.pending.pop(self.next_id))
+            self.next_id += 1
+        self.f.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+        if time.time() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def skip(self, ids):
+        """Write empty lines for ids without outputs (e.g. inputs with invalid sizes, or of other shards),
+        so they do not block the outputs after them."""
+        for id_ in ids:
+            self.write(id_, '')
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._last_sync = time.time()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.sync()
+        self.f.close()
+        if self.pending:
+            logging.warning('{} outputs are not written to {!r}, since the output of id {} is missing'.format(
+                len(self.pending), self.path, self.next_id))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,278 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Binarized, memory-mapped token files.
+
+Each text file of the dataset can be binarized into two files beside it:
+
+```
+# Assume text file = train.iwslt.de-en.de
+train.iwslt.de-en.de.bin    # Flat token buffer, all sentences concatenated
+train.iwslt.de-en.de.idx    # Index: header + offsets + sizes
+```
+
+Index format (little endian):
+    Magic:      8 bytes, ``IndexMagic``
+    Header:     3 x uint64, (version, dtype code, number of sentences)
+    Offsets:    (N + 1) x int64, start offset of each sentence in the token buffer
+    Sizes:      N x int64, number of tokens of each sentence (include EOS)
+
+Both the buffer and the index are opened with ``np.memmap``, so loading is near-instant
+and the pages are shared between all processes on the same host.
+
+Large splits can also be binarized into shards of a fixed number of sentences:
+
+```
+train.iwslt.de-en.de.00000.bin
+train.iwslt.de-en.de.00000.idx
+train.iwslt.de-en.de.00001.bin
+...
+```
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from .tokenizer import Tokenizer
+
+__author__ = 'fyabc'
+
+IndexMagic = b'NASIDX\x00\x00'
+IndexVersion = 1
+
+_DTypes = {
+    1: np.uint8,
+    2: np.int8,
+    3: np.int16,
+    4: np.int32,
+    5: np.int64,
+}
+_DTypeCodes = {np.dtype(v): k for k, v in _DTypes.items()}
+
+_HeaderFormat = '<QQQ'
+_HeaderSize = len(IndexMagic) + struct.calcsize(_HeaderFormat)
+
+
+def data_file_path(prefix):
+    return prefix + '.bin'
+
+
+def index_file_path(prefix):
+    return prefix + '.idx'
+
+
+def dataset_exists(prefix):
+    return os.path.exists(data_file_path(prefix)) and os.path.exists(index_file_path(prefix))
+
+
+def shard_prefix(prefix, shard_id):
+    return '{}.{:05d}'.format(prefix, shard_id)
+
+
+def list_shards(prefix):
+    """Get the prefixes of all existing shards, in order."""
+    shards = []
+    while dataset_exists(shard_prefix(prefix, len(shards))):
+        shards.append(shard_prefix(prefix, len(shards)))
+    return shards
+
+
+def best_dtype(vocab_size):
+    """Get the smallest integer dtype that can store all token ids of the vocabulary.
+
+    [NOTE]: Only use dtypes supported by ``torch.from_numpy``, so buffers can be viewed as tensors without copy.
+    """
+    if vocab_size is not None and vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
+def write_index(path, dtype, sizes):
+    """Write the index file.
+
+    Args:
+        path: Index filename.
+        dtype: Dtype of the token buffer.
+        sizes: Array of sentence sizes.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+
+    with open(path, 'wb') as f:
+        f.write(IndexMagic)
+        f.write(struct.pack(_HeaderFormat, IndexVersion, _DTypeCodes[np.dtype(dtype)], len(sizes)))
+        f.write(offsets.tobytes(order='C'))
+        f.write(sizes.tobytes(order='C'))
+
+
+def read_index(path):
+    """Read the index file.
+
+    Args:
+        path: Index filename.
+
+    Returns:
+        tuple: (dtype, offsets, sizes). Offsets and sizes are read-only memory-mapped arrays.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(IndexMagic))
+        if magic != IndexMagic:
+            raise ValueError('Index file {!r} does not match the expected format'.format(path))
+        version, dtype_code, length = struct.unpack(_HeaderFormat, f.read(struct.calcsize(_HeaderFormat)))
+    if version != IndexVersion:
+        raise ValueError('Unknown index version {} of file {!r}'.format(version, path))
+
+    offsets = np.memmap(path, dtype=np.int64, mode='r', offset=_HeaderSize, shape=(length + 1,))
+    sizes = np.memmap(path, dtype=np.int64, mode='r', offset=_HeaderSize + offsets.nbytes, shape=(length,))
+    return _DTypes[dtype_code], offsets, sizes
+
+
+def read_data(path, dtype, length):
+    """Memory map the token buffer.
+
+    Args:
+        path: Data filename.
+        dtype: Dtype of the token buffer.
+        length: Number of tokens in the buffer.
+
+    Returns:
+        Copy-on-write memory-mapped array. Pages are shared until written.
+    """
+    if length == 0:
+        # [NOTE]: Cannot mmap an empty file.
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='c', shape=(length,))
+
+
+class IndexedDatasetBuilder:
+    """Write tokenized sentences into binarized files."""
+
+    def __init__(self, prefix, dtype=np.int32):
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self._data_file = open(data_file_path(prefix), 'wb')
+        self._sizes = []
+
+    def add_item(self, tokens):
+        """Add a sentence.
+
+        Args:
+            tokens: 1-D tensor or array of token ids.
+        """
+        if hasattr(tokens, 'numpy'):
+            tokens = tokens.numpy()
+        tokens = np.asarray(tokens, dtype=self.dtype)
+        self._data_file.write(tokens.tobytes(order='C'))
+        self._sizes.append(len(tokens))
+
+    def add_array(self, tokens, sizes):
+        """Add a chunk of sentences.
+
+        Args:
+            tokens: 1-D array, token ids of all sentences in the chunk concatenated.
+            sizes: 1-D array, sizes of sentences in the chunk.
+        """
+        self._data_file.write(np.asarray(tokens, dtype=self.dtype).tobytes(order='C'))
+        self._sizes.extend(np.asarray(sizes, dtype=np.int64).tolist())
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def finalize(self):
+        self._data_file.close()
+        write_index(index_file_path(self.prefix), self.dtype, self._sizes)
+
+
+class ShardedDatasetBuilder:
+    """Write tokenized sentences into shards of at most ``shard_size`` sentences."""
+
+    def __init__(self, prefix, dtype=np.int32, shard_size=1000000):
+        assert shard_size > 0
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.num_shards = 0
+        self._size = 0
+        self._builder = None
+
+    def _current_builder(self):
+        if self._builder is None or len(self._builder) >= self.shard_size:
+            if self._builder is not None:
+                self._builder.finalize()
+            self._builder = IndexedDatasetBuilder(shard_prefix(self.prefix, self.num_shards), self.dtype)
+            self.num_shards += 1
+        return self._builder
+
+    def add_item(self, tokens):
+        self._current_builder().add_item(tokens)
+        self._size += 1
+
+    def add_array(self, tokens, sizes):
+        sizes = np.asarray(sizes, dtype=np.int64)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        i = 0
+        while i < len(sizes):
+            builder = self._current_builder()
+            n = min(self.shard_size - len(builder), len(sizes) - i)
+            builder.add_array(tokens[offsets[i]:offsets[i + n]], sizes[i:i + n])
+            i += n
+        self._size += len(sizes)
+
+    def __len__(self):
+        return self._size
+
+    def finalize(self):
+        if self._builder is None:
+            # Always write at least one shard.
+            self._current_builder()
+        self._builder.finalize()
+        self._builder = None
+
+        # Remove stale shards of previous runs, they would be listed as part of this dataset.
+        stale_id = self.num_shards
+        while dataset_exists(shard_prefix(self.prefix, stale_id)):
+            os.remove(data_file_path(shard_prefix(self.prefix, stale_id)))
+            os.remove(index_file_path(shard_prefix(self.prefix, stale_id)))
+            stale_id += 1
+
+
+def binarize(filename, dictionary, prefix, append_eos=True, reverse_order=False):
+    """Tokenize a text file and write it into binarized files.
+
+    Args:
+        filename: Text filename.
+        dictionary (Dictionary):
+        prefix: Output prefix, usually same as the text filename.
+        append_eos:
+        reverse_order:
+
+    Returns:
+        int: Number of sentences.
+    """
+    builder = IndexedDatasetBuilder(prefix, dtype=best_dtype(len(dictionary)))
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            builder.add_item(Tokenizer.tokenize(
+                line, dictionary, add_if_not_exist=False, append_eos=append_eos, reverse_order=reverse_order))
+    builder.finalize()
+    return len(builder)
+
+
+__all__ = [
+    'data_file_path',
+    'index_file_path',
+    'dataset_exists',
+    'shard_prefix',
+    'list_shards',
+    'best_dtype',
+    'write_index',
+    'read_index',
+    'read_data',
+    'IndexedDatasetBuilder',
+    'ShardedDatasetBuilder',
+    'binarize',
+]
@@ -4,7 +4,6 @@
 """Utilities for main entries."""
 
 import collections
-import itertools
 import json
 import logging
 import math
@@ -19,6 +18,7 @@ from ..layers.net_code import get_net_code
 from ..utils.data_processing import LanguageDatasets
 from ..utils.progress_bar import build_progress_bar
 from ..utils.meters import AverageMeter
+from ..utils import distributed_utils
 
 __author__ = 'fyabc'
 
@@ -103,10 +103,20 @@ def main_entry(hparams, **kwargs):
     logging.info('Convolutional search space: {}'.format(hparams.conv_space))
     logging.info('Attention search space: {}'.format(hparams.attn_space))
 
+    if getattr(hparams, 'num_threads', None) is not None:
+        th.set_num_threads(hparams.num_threads)
+    if getattr(hparams, 'num_interop_threads', None) is not None:
+        th.set_num_interop_threads(hparams.num_interop_threads)
+
     if train_:
-        if not th.cuda.is_available():
-            raise RuntimeError('Want to training on GPU but CUDA is not available')
-        th.cuda.set_device(hparams.device_id)
+        if getattr(hparams, 'cpu', False):
+            if not distributed_utils.is_multiprocess():
+                # [NOTE]: Single process on CPU.
+                hparams.distributed_world_size = 1
+        else:
+            if not th.cuda.is_available():
+                raise RuntimeError('Want to training on GPU but CUDA is not available, use --cpu to train on CPU')
+            th.cuda.set_device(hparams.device_id)
         th.manual_seed(hparams.seed)
 
     # Load datasets
@@ -147,7 +157,11 @@ def logging_model_criterion(model, criterion, logging_params=True):
 
 
 def logging_training_stats(hparams):
-    logging.info('Training on {} GPUs'.format(hparams.distributed_world_size))
+    if getattr(hparams, 'cpu', False):
+        logging.info('Training on CPU with {} processes, {} threads per process'.format(
+            hparams.distributed_world_size, th.get_num_threads()))
+    else:
+        logging.info('Training on {} GPUs'.format(hparams.distributed_world_size))
     logging.info('Max tokens per GPU = {}, max sentences per GPU = {}'.format(
         hparams.max_tokens,
         hparams.max_sentences,
@@ -212,9 +226,18 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
         sort_by_source_size=(epoch <= hparams.curriculum),
         shard_id=hparams.distributed_rank,
         num_shards=hparams.distributed_world_size,
+        collate_buffers=getattr(hparams, 'collate_buffers', 0),
+        num_workers=getattr(hparams, 'num_workers', 0),
+        prefetch=getattr(hparams, 'prefetch', 0),
+        pin_memory=getattr(hparams, 'pin_memory', False),
+        batch_offset=batch_offset,
+        shard_strategy=getattr(hparams, 'shard_strategy', 'round_robin'),
+        planner=getattr(hparams, 'batch_planner', 'sorted'),
+        num_length_buckets=getattr(hparams, 'num_length_buckets', 16),
+        min_length=getattr(hparams, 'min_length', 1),
+        max_ratio=getattr(hparams, 'max_length_ratio', None),
     )
 
-    next(itertools.islice(itr, batch_offset, batch_offset), None)
     progress = build_progress_bar(hparams, itr, epoch, no_progress_bar='simple')
 
     # update parameters every N batches
@@ -231,7 +254,7 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
 
     extra_meters = collections.defaultdict(lambda: AverageMeter())
     max_update = hparams.max_update or math.inf
-    num_batches = len(itr)
+    num_batches = batch_offset + len(itr)
     for i, sample in enumerate(progress, start=batch_offset):
         if i < num_batches - 1 and (i + 1) % update_freq > 0:
             trainer.train_step(sample, update_params=False)
@@ -241,6 +264,7 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
 
         # Log mid-epoch stats
         stats = get_training_stats(trainer)
+        stats['load'] = '{:.0%}'.format(itr.wait_ratio())
         for k, v in log_output.items():
             if k in ['loss', 'nll_loss']:
                 continue  # these are already logged above
@@ -265,6 +289,7 @@ def train(hparams, trainer, datasets, epoch, batch_offset):
 
     # Log end-of-epoch stats
     stats = get_training_stats(trainer)
+    stats['load'] = '{:.0%}'.format(itr.wait_ratio())
     for k, meter in extra_meters.items():
         stats[k] = meter.avg
     progress.print(stats)
@@ -24,15 +24,11 @@ class Tokenizer:
         words = line_tokenizer(line)
         if reverse_order:
             words = list(reversed(words))
-        nwords = len(words)
-        ids = tensor_type(nwords + 1 if append_eos else nwords)
-
-        for i, word in enumerate(words):
-            idx = dictionary.get(word, add_if_not_exist=add_if_not_exist)
-            if consumer is not None:
+        ids = [dictionary.get(word, add_if_not_exist=add_if_not_exist) for word in words]
+        if consumer is not None:
+            for word, idx in zip(words, ids):
                 consumer(word, idx)
-            ids[i] = idx
         if append_eos:
-            ids[nwords] = dictionary.eos_id
-        return ids
+            ids.append(dictionary.eos_id)
+        return tensor_type(ids)
 
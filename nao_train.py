@@ -45,6 +45,7 @@ class NAOTrainer(ChildTrainer):
     ArchDist = False            # Train different arch on different GPUs.
     GenSortByLength = False     # Sort by length in generation.
     GenMaxlenB = 100            # Max length bias in generation. (less than normal generation to avoid oom)
+    FlatParams = False          # Parameters of the shared model change between updates.
 
     def __init__(self, hparams, criterion, only_epd_cuda=False):
         # [NOTE]: Model is a "shared" model here.
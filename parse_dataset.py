@@ -1,30 +1,31 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
 
+"""Compute statistics of the dataset, and store them beside the data (see ``libs/utils/dataset_stats.py``)."""
+
 import argparse
-import os
+import multiprocessing
 
 from libs.utils.paths import get_data_path
+from libs.utils import dataset_stats
 from libs.tasks import get_task
 
 __author__ = 'fyabc'
 
 
-def scan_file(f):
-    n = 0
-    total_length = 0
-
-    for line in f:
-        words = line.strip().split()
-        n += 1
-        total_length += len(words)
-
-    return n, total_length
-
-
 def main(args=None):
     parser = argparse.ArgumentParser('Parse the dataset, get some other information.')
     parser.add_argument('-T', '--task', help='The task to parse')
+    parser.add_argument('--data-dir', default=None, type=str, metavar='DIR',
+                        help='Data save directory, default is "$PROJECT/data/"')
+    parser.add_argument('--splits', default='train,dev,test', metavar='SPLITS',
+                        help='Comma separated list of splits to parse, default is %(default)s')
+    parser.add_argument('-j', '--workers', default=multiprocessing.cpu_count(), type=int, metavar='N',
+                        help='Number of processes, default is %(default)s')
+    parser.add_argument('--chunk-size', default=10000, type=int, metavar='N',
+                        help='Number of lines sent to a process at once, default is %(default)s')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Recompute the statistics even if they are cached')
 
     hparams = parser.parse_args(args=args)
 
@@ -33,15 +34,31 @@ def main(args=None):
     task = get_task(hparams.task)
 
     dataset_dir = get_data_path(hparams)
-
-    for split in ('train', 'dev', 'test'):
-        for is_src in (True, False):
-            filename = task.get_filename(split, is_src_lang=is_src)
-
-            with open(os.path.join(dataset_dir, filename), 'r', encoding='utf-8') as f:
-                n, total_length = scan_file(f)
-                print('{} {}: {} sentences, average length = {}'.format(
-                    'Src' if is_src else 'Trg', split, n, total_length / n))
+    stats_path = dataset_stats.stats_file_path(dataset_dir, task)
+
+    stats = (None if hparams.force else dataset_stats.load_stats(stats_path)) or {}
+    missing_splits = [split for split in hparams.splits.split(',') if split not in stats]
+    if missing_splits:
+        stats.update(dataset_stats.compute_stats(
+            task, dataset_dir, missing_splits, workers=hparams.workers, chunk_size=hparams.chunk_size))
+        dataset_stats.save_stats(stats_path, stats)
+        print('Statistics saved to {}'.format(stats_path))
+
+    for split in hparams.splits.split(','):
+        split_stats = stats[split]
+        for key in ('src', 'trg'):
+            s = split_stats[key]
+            print('{} {}: {} sentences, average length = {}, std = {:.2f}, max = {}, percentiles = {}, '
+                  'coverage = {:.3%}'.format(
+                      key.capitalize(), split, split_stats['num_sentences'], s['mean'], s['std'], s['max'],
+                      s['percentiles'], s['coverage']))
+        ratio = split_stats['ratio']
+        print('Ratio {}: mean = {:.3f}, std = {:.3f}, percentiles = {}, '
+              'trg = {:.3f} * src + {:.3f} (residual std = {:.3f})'.format(
+                  split, ratio['mean'], ratio['std'], ratio['percentiles'], *ratio['fit']))
+
+    a, b = dataset_stats.maxlen_a_b(stats) if 'train' in stats else task.get_maxlen_a_b()
+    print('Generation maxlen: a = {:.3f}, b = {:.3f}'.format(a, b))
 
 
 if __name__ == '__main__':
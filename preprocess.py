@@ -0,0 +1,155 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Binarize the dataset of a task.
+
+Tokenize the text files of each split with the task dictionaries in a process pool,
+and write the binarized files (see ``libs/utils/indexed_dataset.py``) beside them.
+"""
+
+import argparse
+from itertools import islice
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from libs.utils.paths import get_data_path
+from libs.utils.dictionary import Dictionary
+from libs.utils.tokenizer import Tokenizer
+from libs.utils import indexed_dataset
+from libs.utils.data_processing import filter_file_path, build_filter
+from libs.tasks import get_task
+
+__author__ = 'fyabc'
+
+
+_worker_dictionary = None
+
+
+def _init_worker(dictionary):
+    global _worker_dictionary
+    _worker_dictionary = dictionary
+
+
+def _binarize_chunk(lines):
+    """Tokenize a chunk of lines in the worker.
+
+    Returns:
+        tuple: (tokens, sizes, number of words, number of unknown words)
+    """
+    dictionary = _worker_dictionary
+    dtype = indexed_dataset.best_dtype(len(dictionary))
+    tokens_list = [
+        Tokenizer.tokenize(line, dictionary, add_if_not_exist=False).numpy()
+        for line in lines
+    ]
+    sizes = np.array([len(t) for t in tokens_list], dtype=np.int64)
+    tokens = np.concatenate(tokens_list).astype(dtype) if tokens_list else np.empty(0, dtype=dtype)
+    n_words = int(sizes.sum()) - len(sizes)     # Exclude EOS
+    n_unk = int(np.count_nonzero(tokens == dictionary.unk_id))
+    return tokens, sizes, n_words, n_unk
+
+
+def _iter_chunks(f, chunk_size):
+    while True:
+        chunk = list(islice(f, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def binarize_file(filename, dictionary, pool, chunk_size, shard_size=0):
+    """Binarize a text file with the process pool.
+
+    Args:
+        shard_size: Write shards of this number of sentences, 0 means do not shard.
+
+    Returns:
+        tuple: (number of lines, number of words, number of unknown words)
+    """
+    dtype = indexed_dataset.best_dtype(len(dictionary))
+    if shard_size > 0:
+        builder = indexed_dataset.ShardedDatasetBuilder(filename, dtype=dtype, shard_size=shard_size)
+    else:
+        builder = indexed_dataset.IndexedDatasetBuilder(filename, dtype=dtype)
+    n_words, n_unk = 0, 0
+    with open(filename, 'r', encoding='utf-8') as f:
+        for tokens, sizes, chunk_words, chunk_unk in pool.imap(_binarize_chunk, _iter_chunks(f, chunk_size)):
+            builder.add_array(tokens, sizes)
+            n_words += chunk_words
+            n_unk += chunk_unk
+    builder.finalize()
+    return len(builder), n_words, n_unk
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser('Binarize the dataset of the task.')
+    parser.add_argument('-T', '--task', help='The task to binarize')
+    parser.add_argument('--data-dir', default=None, type=str, metavar='DIR',
+                        help='Data save directory, default is "$PROJECT/data/"')
+    parser.add_argument('--splits', default='train,dev,test', metavar='SPLITS',
+                        help='Comma separated list of splits to binarize, default is %(default)s')
+    parser.add_argument('-j', '--workers', default=multiprocessing.cpu_count(), type=int, metavar='N',
+                        help='Number of tokenization processes, default is %(default)s')
+    parser.add_argument('--chunk-size', default=10000, type=int, metavar='N',
+                        help='Number of lines sent to a process at once, default is %(default)s')
+    parser.add_argument('--shard-size', default=0, type=int, metavar='N',
+                        help='Binarize into shards of N sentences for streaming (--stream-shards), '
+                             'default is %(default)s (do not shard)')
+    parser.add_argument('--shard-splits', default='train', metavar='SPLITS',
+                        help='Comma separated list of splits to shard, default is %(default)s')
+    parser.add_argument('--filter-max-positions', default=None, metavar='N[,N]',
+                        help='Build the filter of valid samples of unsharded splits with max source and target '
+                             'positions, should be same as training (--max-src-positions, --max-trg-positions)')
+    parser.add_argument('--filter-min-length', default=1, type=int, metavar='N',
+                        help='Min length of the filter (same as --min-length), default is %(default)s')
+    parser.add_argument('--filter-max-ratio', default=None, type=float, metavar='R',
+                        help='Max length ratio of the filter (same as --max-length-ratio), default is no limit')
+
+    hparams = parser.parse_args(args=args)
+
+    print('#', hparams.task)
+
+    task = get_task(hparams.task)
+
+    dataset_dir = get_data_path(hparams)
+
+    for is_src in (True, False):
+        dictionary = Dictionary(
+            os.path.join(dataset_dir, task.get_filename('dict', is_src_lang=is_src)),
+            task, is_src_lang=is_src, mode=task.SourceDictType if is_src else task.TargetDictType)
+
+        with multiprocessing.Pool(hparams.workers, initializer=_init_worker, initargs=(dictionary,)) as pool:
+            for split in hparams.splits.split(','):
+                filename = os.path.join(dataset_dir, task.get_filename(split, is_src_lang=is_src))
+                shard_size = hparams.shard_size if split in hparams.shard_splits.split(',') else 0
+
+                start_time = time.time()
+                n, n_words, n_unk = binarize_file(filename, dictionary, pool, hparams.chunk_size, shard_size)
+                elapsed = max(time.time() - start_time, 1e-6)
+
+                print('{} {}: {} sentences, {:.1f} lines/s, {} words, unknown rate = {:.3%}'.format(
+                    'Src' if is_src else 'Trg', split, n, n / elapsed, n_words, n_unk / max(n_words, 1)))
+
+    if hparams.filter_max_positions is not None:
+        max_positions = [int(p) for p in hparams.filter_max_positions.split(',')]
+        if len(max_positions) == 1:
+            max_positions *= 2
+        for split in hparams.splits.split(','):
+            if hparams.shard_size > 0 and split in hparams.shard_splits.split(','):
+                continue
+            src_sizes, trg_sizes = [
+                indexed_dataset.read_index(indexed_dataset.index_file_path(
+                    os.path.join(dataset_dir, task.get_filename(split, is_src_lang=is_src))))[2]
+                for is_src in (True, False)
+            ]
+            mask = build_filter(
+                filter_file_path(dataset_dir, task, split), src_sizes, trg_sizes, max_positions,
+                min_length=hparams.filter_min_length, max_ratio=hparams.filter_max_ratio)
+            print('Filter {}: {} of {} samples are valid'.format(split, int(mask.sum()), len(mask)))
+
+
+if __name__ == '__main__':
+    main()